@@ -0,0 +1,196 @@
+"""
+Clock synchronization between Puff nodes over UDP, NTP style, for playing one show on several nodes at once.
+
+The leader answers every request with the time it received it and the time it replied. A follower sends a
+request every interval and turns each exchange into an offset and a round trip delay sample:
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay = (t4 - t1) - (t3 - t2)
+where t1/t4 are follower send/receive times and t2/t3 are leader receive/send times. Samples with the lowest
+delay are the least disturbed by queueing, so the estimate fits a line through the lower-delay half of a
+sliding window, giving an offset and a drift rate. Clocks are monotonic_ns on both ends.
+
+Leader and follower both provide to_local()/to_leader(), converting between leader time and this node's
+monotonic clock, so a show can be started on every node at the same leader time.
+"""
+import socket
+import struct
+import threading
+from collections import deque
+from time import monotonic_ns
+
+__author__ = 'Stu D\'Alessandro'
+
+MAGIC = b'PUFC'
+REQUEST = struct.Struct('!4sIq')  # magic, sequence, t1
+REPLY = struct.Struct('!4sIqqq')  # magic, sequence, t1, t2, t3
+
+
+class ClockLeader(object):
+    """ Answers clock requests; leader time is this node's monotonic clock """
+    def __init__(self, addr=('', 4446)):
+        """
+        :param addr: (host, port) to answer requests on
+        :return: nil
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.settimeout(0.5)  # so close() is noticed
+        self.addr = self.sock.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        buf = bytearray(REQUEST.size)
+        reply = bytearray(REPLY.size)
+        while self.running:
+            try:
+                nbytes, sender = self.sock.recvfrom_into(buf)
+                t2 = monotonic_ns()
+            except OSError:
+                continue
+            if nbytes != REQUEST.size:
+                continue
+            magic, sequence, t1 = REQUEST.unpack_from(buf)
+            if magic != MAGIC:
+                continue
+            REPLY.pack_into(reply, 0, MAGIC, sequence, t1, t2, monotonic_ns())
+            try:
+                self.sock.sendto(reply, sender)
+            except OSError:
+                pass
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        self.thread.join(1.0)
+
+    def synchronized(self):
+        return True
+
+    def to_local(self, leader_ns):
+        return leader_ns
+
+    def to_leader(self, local_ns):
+        return local_ns
+
+
+class ClockFollower(object):
+    """ Tracks the offset and drift of a leader's clock relative to this node's monotonic clock """
+    def __init__(self, leader_addr, interval=1.0, window=32, min_samples=4):
+        """
+        :param leader_addr: (host, port) of the ClockLeader
+        :param interval: seconds between requests once synchronized
+        :param window: number of samples kept
+        :param min_samples: samples needed before the node counts as synchronized
+        :return: nil
+        """
+        self.leader_addr = leader_addr
+        self.interval = interval
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window)  # (local midpoint ns, offset ns, delay ns)
+        self.estimate = (0, 0.0, 0.0)  # (reference local ns, offset ns at reference, drift)
+        self.sequence = 0
+        self.stopped = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(0.25)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        buf = bytearray(REPLY.size)
+        while not self.stopped.is_set():
+            self.exchange(buf)
+            # poll quickly until synchronized, then settle down
+            self.stopped.wait(self.interval if self.synchronized() else 0.05)
+
+    def exchange(self, buf):
+        """
+        Sends one request and records the sample from the reply
+        :param buf: reusable receive buffer
+        :return: True if a sample was recorded
+        """
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        try:
+            self.sock.sendto(REQUEST.pack(MAGIC, self.sequence, monotonic_ns()), self.leader_addr)
+            while True:
+                nbytes = self.sock.recv_into(buf)
+                t4 = monotonic_ns()
+                if nbytes != REPLY.size:
+                    continue
+                magic, sequence, t1, t2, t3 = REPLY.unpack_from(buf)
+                if magic == MAGIC and sequence == self.sequence:
+                    break
+        except OSError:
+            return False
+        self.add_sample(t1, t2, t3, t4)
+        return True
+
+    def add_sample(self, t1, t2, t3, t4):
+        """
+        Records one exchange and updates the estimate
+        :param t1: follower send time
+        :param t2: leader receive time
+        :param t3: leader send time
+        :param t4: follower receive time
+        :return: nil
+        """
+        offset = ((t2 - t1) + (t3 - t4)) / 2.0
+        delay = (t4 - t1) - (t3 - t2)
+        self.samples.append(((t1 + t4) // 2, offset, delay))
+
+        samples = sorted(self.samples, key=lambda s: s[2])
+        best = samples[:max(2, len(samples) // 2)]
+        reference = best[0][0]
+        if len(best) < self.min_samples:
+            self.estimate = (reference, best[0][1], 0.0)
+            return
+
+        # least squares line through the low delay samples
+        n = float(len(best))
+        mean_x = sum(s[0] - reference for s in best) / n
+        mean_y = sum(s[1] for s in best) / n
+        sxx = sum((s[0] - reference - mean_x) ** 2 for s in best)
+        drift = 0.0
+        if sxx > 0:
+            drift = sum((s[0] - reference - mean_x) * (s[1] - mean_y) for s in best) / sxx
+        self.estimate = (reference, mean_y - drift * mean_x, drift)
+
+    def synchronized(self):
+        """
+        :return: True once enough samples have been collected
+        """
+        return len(self.samples) >= self.min_samples
+
+    def offset(self, local_ns=None):
+        """
+        :param local_ns: local monotonic_ns time, now if None
+        :return: leader time minus local time in ns
+        """
+        if local_ns is None:
+            local_ns = monotonic_ns()
+        reference, offset, drift = self.estimate
+        return offset + drift * (local_ns - reference)
+
+    def to_leader(self, local_ns):
+        """
+        :param local_ns: local monotonic_ns time
+        :return: the leader's clock at that moment
+        """
+        return int(local_ns + self.offset(local_ns))
+
+    def to_local(self, leader_ns):
+        """
+        :param leader_ns: leader monotonic_ns time
+        :return: the local monotonic_ns time at which the leader's clock reads leader_ns
+        """
+        reference, offset, drift = self.estimate
+        return int((leader_ns - offset + drift * reference) / (1.0 + drift))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(1.0)
+        self.sock.close()
@@ -0,0 +1,299 @@
+"""
+Fuel and pressure budget for a bank whose channels all draw from one propane accumulator.
+
+Every channel has a nominal flow, the fuel it burns per second at full supply pressure. The accumulator holds
+capacity units of fuel at supply pressure and is refilled by the regulator at refill units per second when
+empty, less as it fills. Pressure is proportional to the fuel in the accumulator and an open channel's flow to
+the pressure, so with a total nominal flow F open the charge C follows
+    dC/dt = refill * (1 - C / capacity) - F * C / capacity
+While the bank does not change F is constant and this has a closed form, so the model only does work when
+channels change: it advances the charge and the fuel used to the time of the change in O(1), then adds or
+removes the flow of the channels that changed. A frame costs O(changed channels), never a rescan of the bank.
+
+Attached to a GPIOFireBank the model can also enforce limits: a frame that would open more channels than
+max_open, more nominal flow than max_flow, open anything while pressure is below min_pressure or once budget
+units of fuel have been used has its openings refused; channels turning off are always let through. simulate()
+runs the same model over a show file offline.
+
+Model files are plain text, one setting per line:
+    flow 1.5            # nominal flow of every channel, units per second
+    flow 3 2.5          # nominal flow of channel 3
+    capacity 20         # units in the accumulator at supply pressure
+    refill 4            # units per second the regulator delivers into an empty accumulator
+    pressure 30         # supply pressure, psi
+    max_open 6          # limits, all optional
+    max_flow 12
+    min_pressure 15
+    budget 5000
+
+Usage: python FuelModel.py fuel.txt show.puff
+"""
+import sys
+from array import array
+from math import exp
+
+import PuffLog
+from ShowFile import ShowFile
+from ShowValidator import cues
+
+__author__ = 'Stu D\'Alessandro'
+
+
+class FuelModel(object):
+    """ Fuel used and accumulator pressure of a bank, updated as its channels change """
+    def __init__(self, flows, capacity=10.0, refill=5.0, supply_pressure=30.0, max_open=None, max_flow=None,
+                 min_pressure=None, budget=None):
+        """
+        :param flows: nominal flow of each channel, units per second at supply pressure
+        :param capacity: units of fuel in the accumulator at supply pressure
+        :param refill: units per second the regulator delivers into an empty accumulator
+        :param supply_pressure: pressure of a full accumulator, psi
+        :param max_open: most channels open at once, None for no limit
+        :param max_flow: most total nominal flow open at once, None for no limit
+        :param min_pressure: no channel is opened while the pressure is below this, None for no limit
+        :param budget: no channel is opened once this much fuel has been used, None for no limit
+        :return: nil
+        :raise ValueError: if a setting is out of range
+        """
+        self.flows = array('d', flows)
+        if capacity <= 0 or refill < 0 or min(self.flows, default=0) < 0 or (max_open is not None and max_open < 0):
+            raise ValueError('capacity must be above 0, and refill, flows and max_open 0 or more')
+        self.capacity = float(capacity)
+        self.refill = float(refill)
+        self.supply_pressure = float(supply_pressure)
+        self.max_open = max_open
+        self.max_flow = max_flow
+        self.min_pressure = min_pressure
+        self.budget = budget
+        self.limited = any(limit is not None for limit in (max_open, max_flow, min_pressure, budget))
+        self.quiet = False  # True to count refusals without logging them, for offline runs
+        self.refusing = None  # reason the last frame's openings were refused, None if they were let through
+        self.reset()
+
+    def copy(self):
+        """
+        :return: a new model with the same settings, full and idle, e.g. for an offline run
+        """
+        return FuelModel(self.flows, self.capacity, self.refill, self.supply_pressure, self.max_open,
+                         self.max_flow, self.min_pressure, self.budget)
+
+    def reset(self, now=0.0):
+        """
+        Full accumulator, nothing open, nothing used
+        :param now: time the model starts at, seconds on the clock update() will be called with
+        :return: nil
+        """
+        self.flow = 0.0  # total nominal flow of the open channels
+        self.open = 0  # channels open
+        self.charge = self.capacity  # units in the accumulator at updated_at
+        self.used = 0.0  # units burned up to updated_at
+        self.updated_at = now
+        self.refused = 0  # channel openings refused by the limits
+        self.peak_open = 0
+        self.peak_flow = 0.0
+        self.low_pressure = self.supply_pressure  # lowest pressure seen
+        self.low_pressure_at = now
+
+    def sync(self, now, mask):
+        """
+        Takes the open channels from a whole mask, e.g. when the model is attached to a bank that is running
+        :param now: time of the mask
+        :param mask: channels open, bit 0 is channel 1
+        :return: nil
+        """
+        self._advance(now)
+        self.flow = 0.0
+        self.open = 0
+        self._changed(mask, mask)
+
+    def project(self, now):
+        """
+        Where the accumulator will be at a time, without changing the model
+        :param now: time at or after the last update
+        :return: (charge, units used) at that time
+        """
+        dt = now - self.updated_at
+        rate = (self.refill + self.flow) / self.capacity
+        if dt <= 0 or rate == 0:
+            return self.charge, self.used
+        steady = self.refill / rate  # charge the accumulator settles at with this flow
+        decay = exp(-rate * dt)
+        charge = steady + (self.charge - steady) * decay
+        used = self.used + self.flow / self.capacity * (steady * dt + (self.charge - steady) * (1 - decay) / rate)
+        return charge, used
+
+    def estimate(self, now):
+        """
+        :param now: time at or after the last update
+        :return: (pressure in psi, units used) at that time
+        """
+        charge, used = self.project(now)
+        return self.supply_pressure * charge / self.capacity, used
+
+    def admit(self, state, mask, now):
+        """
+        Applies the limits to a frame
+        :param state: channels open now
+        :param mask: channels the frame wants open
+        :param now: time of the frame
+        :return: mask with the openings removed if they break a limit
+        """
+        opening = mask & ~state
+        if not opening or not self.limited:
+            return mask
+        closing = state & ~mask  # channels closed by the same frame make room for the ones it opens
+        count = bin(opening).count('1')
+        reason = None
+        if self.max_open is not None and self.open - bin(closing).count('1') + count > self.max_open:
+            reason = 'max_open'
+        elif self.max_flow is not None and \
+                self.flow - self._flow_of(closing) + self._flow_of(opening) > self.max_flow + 1e-9:
+            reason = 'max_flow'
+        elif self.min_pressure is not None or self.budget is not None:
+            pressure, used = self.estimate(now)
+            if self.min_pressure is not None and pressure < self.min_pressure:
+                reason = 'min_pressure'
+            elif self.budget is not None and used >= self.budget:
+                reason = 'budget'
+        if reason is None:
+            self.refusing = None
+            return mask
+        self.refused += count
+        # once the budget is spent every frame is refused, so only the start of a run of refusals is logged
+        if reason != self.refusing and not self.quiet:
+            PuffLog.warning('fuel_refused', reason=reason, mask=hex(opening), open=self.open)
+        self.refusing = reason
+        return mask & ~opening
+
+    def update(self, now, changed, mask):
+        """
+        Accounts for channels that changed
+        :param now: time of the change
+        :param changed: channels that changed
+        :param mask: channels open after the change
+        :return: nil
+        """
+        self._advance(now)
+        self._changed(changed, mask)
+
+    def _flow_of(self, mask):
+        flows = self.flows
+        flow = 0.0
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            flow += flows[low.bit_length() - 1]
+        return flow
+
+    def _advance(self, now):
+        """ Brings the charge and fuel used up to now at the current flow """
+        self.charge, self.used = self.project(now)
+        self.updated_at = max(now, self.updated_at)
+        # with the flow constant the charge moves steadily towards where it settles, so the lowest pressure
+        # is always at a change
+        pressure = self.supply_pressure * self.charge / self.capacity
+        if pressure < self.low_pressure:
+            self.low_pressure = pressure
+            self.low_pressure_at = now
+
+    def _changed(self, changed, mask):
+        opened = changed & mask
+        closed = changed & ~mask
+        if opened:
+            self.flow += self._flow_of(opened)
+            self.open += bin(opened).count('1')
+        if closed:
+            self.open -= bin(closed).count('1')
+            # recompute from nothing when the bank closes so rounding does not accumulate
+            self.flow = self.flow - self._flow_of(closed) if self.open else 0.0
+        if self.open > self.peak_open:
+            self.peak_open = self.open
+        if self.flow > self.peak_flow:
+            self.peak_flow = self.flow
+
+
+def load_fuel_model(path, num_channels):
+    """
+    Reads a model file
+    :param path: file to read, see the module docstring for the format
+    :param num_channels: channels in the bank
+    :return: FuelModel
+    :raise ValueError: if the file is malformed
+    """
+    flows = [1.0] * num_channels
+    settings = {}
+    names = {'capacity': float, 'refill': float, 'pressure': float, 'max_open': int, 'max_flow': float,
+             'min_pressure': float, 'budget': float}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                if fields[0] == 'flow' and len(fields) == 2:
+                    flows = [float(fields[1])] * num_channels
+                elif fields[0] == 'flow' and len(fields) == 3:
+                    channel = int(fields[1])
+                    if not 0 < channel <= num_channels:
+                        raise ValueError('no channel {0}'.format(channel))
+                    flows[channel - 1] = float(fields[2])
+                elif fields[0] in names and len(fields) == 2:
+                    settings[fields[0]] = names[fields[0]](fields[1])
+                else:
+                    raise ValueError('unknown setting "{0}"'.format(line.strip()))
+            except ValueError as e:
+                raise ValueError('{0} line {1}: {2}'.format(path, number, e))
+    if 'pressure' in settings:
+        settings['supply_pressure'] = settings.pop('pressure')
+    try:
+        return FuelModel(flows, **settings)
+    except ValueError as e:
+        raise ValueError('{0}: {1}'.format(path, e))
+
+
+def simulate(model, show):
+    """
+    Plays a show through a model offline, applying its limits to every cue as a bank would
+    :param model: FuelModel, reset before the run
+    :param show: Show, ShowFile or anything with the same cue methods
+    :return: model, holding the totals of the run
+    """
+    all_mask = (1 << len(model.flows)) - 1
+    model.reset()
+    model.quiet = True
+    state = 0
+    time = 0.0
+    for time, mask in cues(show):
+        mask = model.admit(state, mask & all_mask, time)
+        changed = mask ^ state
+        if changed:
+            model.update(time, changed, mask)
+            state = mask
+    model.update(time, 0, state)
+    return model
+
+
+def main(argv):
+    """
+    Runs a show file through a fuel model and prints the totals
+    :return: 0 if no cue was refused, 1 if not
+    """
+    if len(argv) != 2:
+        print('Usage FuelModel fuel.txt show.puff')
+        sys.exit(2)
+    try:
+        show = ShowFile(argv[1])
+        model = load_fuel_model(argv[0], show.num_channels)
+    except (IOError, ValueError) as e:
+        print('Unable to load: {0}'.format(e))
+        sys.exit(2)
+    simulate(model, show)
+    print('{0:.1f} s, {1:.1f} units of fuel, peak {2} channels and {3:.2f} units/s open'.format(
+        show.duration(), model.used, model.peak_open, model.peak_flow))
+    print('Lowest pressure {0:.1f} psi at {1:.3f} s, {2} channel openings refused'.format(
+        model.low_pressure, model.low_pressure_at, model.refused))
+    show.close()
+    return 0 if model.refused == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,309 @@
+"""
+Backends that drive the GPIO pins of a GPIOFireBank.
+RPiGPIOBackend uses the Raspberry Pi GPIO library, GPIOMemBackend writes the GPIO registers directly through
+an mmap of /dev/gpiomem, SimulatedGPIOBackend keeps pin levels in memory and records every transition with a
+nanosecond timestamp, and NullGPIOBackend does nothing. A bank always writes its pins through one
+backend.output_masks(set_mask, clear_mask) call per frame, bit n of each mask being BCM pin n.
+
+Usage: python GPIOBackend.py, to check GPIOMemBackend's register writes against an anonymous mapping
+"""
+import mmap
+import os
+import sys
+from array import array
+from time import monotonic_ns
+
+import PuffLog
+
+__author__ = 'Stu D\'Alessandro'
+
+
+# Install Raspberry Pi GPIO class
+gpio_present = True
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    PuffLog.warning('gpio_library_missing', library='RPi.GPIO')
+    gpio_present = False
+
+
+class GPIOBackend(object):
+    """ Interface for the hardware behind a bank's pins """
+    name = None
+
+    def setup(self, pins):
+        """
+        Configures pins as outputs
+        :param pins: list of GPIO pin numbers
+        :return: nil
+        """
+        pass
+
+    def output(self, pins, values):
+        """
+        Writes several pins at once
+        :param pins: list of GPIO pin numbers
+        :param values: list of 0/1 values, one per pin
+        :return: nil
+        """
+        pass
+
+    def output_masks(self, set_mask, clear_mask):
+        """
+        Drives the pins whose bits are set in set_mask high and those set in clear_mask low. Backends that can
+        write a whole register at once override this; the default makes one output() call.
+        :param set_mask: bit n set to drive BCM pin n high
+        :param clear_mask: bit n set to drive BCM pin n low
+        :return: nil
+        """
+        pins = []
+        values = []
+        for mask, value in ((set_mask, 1), (clear_mask, 0)):
+            while mask:
+                low = mask & -mask
+                mask ^= low
+                pins.append(low.bit_length() - 1)
+                values.append(value)
+        if pins:
+            self.output(pins, values)
+
+    def cleanup(self):
+        """
+        Releases the pins
+        :return: nil
+        """
+        pass
+
+
+class NullGPIOBackend(GPIOBackend):
+    """ Accepts every write and does nothing """
+    name = 'null'
+
+
+class RPiGPIOBackend(GPIOBackend):
+    """ Drives real pins with the RPi.GPIO library """
+    name = 'rpi'
+
+    def __init__(self):
+        if not gpio_present:
+            raise RuntimeError("The Raspberry Pi GPIO library is not available")
+
+    def setup(self, pins):
+        GPIO.setmode(GPIO.BCM)  # GPIO.BCM for IO pins, GPIO.BOARD for connector pins
+        GPIO.setwarnings(False)
+        for pin in pins:
+            GPIO.setup(pin, GPIO.OUT)
+
+    def output(self, pins, values):
+        GPIO.output(pins, values)
+
+    def cleanup(self):
+        GPIO.cleanup()
+
+
+class GPIOMemBackend(GPIOBackend):
+    """
+    Writes the BCM2835 GPIO registers directly. /dev/gpiomem exposes just the GPIO register block and needs
+    no root. A frame is one store to GPSET0 and one to GPCLR0 (plus GPSET1/GPCLR1 for pins 32-53), so all the
+    pins going high change in the same bus cycle, and likewise all those going low. The register block can be
+    any mmap, e.g. an anonymous one for testing, where the last value stored in each register can be read
+    back.
+    """
+    name = 'mem'
+
+    BLOCK_SIZE = 4096
+    GPFSEL0 = 0x00  # function select, 3 bits per pin, 10 pins per register
+    GPSET0 = 0x1C
+    GPSET1 = 0x20
+    GPCLR0 = 0x28
+    GPCLR1 = 0x2C
+    FSEL_INPUT = 0
+    FSEL_OUTPUT = 1
+
+    def __init__(self, path='/dev/gpiomem', block=None):
+        """
+        :param path: device to map the register block from
+        :param block: already mapped register block to use instead of path, at least 0xB4 bytes
+        :return: nil
+        """
+        self.owned = block is None
+        if block is None:
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_SYNC)
+            except OSError as e:
+                raise RuntimeError('Unable to open {0}: {1}'.format(path, e))
+            try:
+                block = mmap.mmap(fd, self.BLOCK_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+        self.block = block
+        self.regs = memoryview(block).cast('I')  # native 32 bit words, each store is one register write
+        self.pins = []
+
+    def setup(self, pins):
+        for pin in pins:
+            self.set_function(pin, self.FSEL_OUTPUT)
+        self.pins = list(pins)
+
+    def set_function(self, pin, function):
+        """
+        Read-modify-writes the 3 bit function select field of a pin
+        :param pin: BCM pin number
+        :param function: FSEL_INPUT, FSEL_OUTPUT or an alternate function code
+        :return: nil
+        """
+        index = self.GPFSEL0 // 4 + pin // 10
+        shift = (pin % 10) * 3
+        self.regs[index] = (self.regs[index] & ~(7 << shift)) | (function << shift)
+
+    def output(self, pins, values):
+        set_mask = 0
+        clear_mask = 0
+        for pin, value in zip(pins, values):
+            if value:
+                set_mask |= 1 << pin
+            else:
+                clear_mask |= 1 << pin
+        self.output_masks(set_mask, clear_mask)
+
+    def output_masks(self, set_mask, clear_mask):
+        regs = self.regs
+        if set_mask & 0xFFFFFFFF:
+            regs[7] = set_mask & 0xFFFFFFFF  # GPSET0
+        if clear_mask & 0xFFFFFFFF:
+            regs[10] = clear_mask & 0xFFFFFFFF  # GPCLR0
+        if set_mask >> 32:
+            regs[8] = (set_mask >> 32) & 0x3FFFFF  # GPSET1
+        if clear_mask >> 32:
+            regs[11] = (clear_mask >> 32) & 0x3FFFFF  # GPCLR1
+
+    def cleanup(self):
+        """
+        Drives the pins low and returns them to inputs
+        :return: nil
+        """
+        mask = 0
+        for pin in self.pins:
+            mask |= 1 << pin
+        self.output_masks(0, mask)
+        for pin in self.pins:
+            self.set_function(pin, self.FSEL_INPUT)
+        self.pins = []
+        self.regs.release()
+        if self.owned:
+            self.block.close()
+
+
+class SimulatedGPIOBackend(GPIOBackend):
+    """
+    Keeps pin levels in memory and records every transition as (monotonic_ns timestamp, pin, value) in
+    compact arrays, so the full command to pin path can be measured without a Pi
+    """
+    name = 'sim'
+
+    def __init__(self, record=True):
+        """
+        :param record: False to only track levels, e.g. for long benchmarks
+        :return: nil
+        """
+        self.record = record
+        self.levels = {}
+        self.times = array('q')
+        self.pins = array('H')
+        self.values = array('B')
+
+    def setup(self, pins):
+        for pin in pins:
+            self.levels[pin] = 0
+
+    def output(self, pins, values):
+        levels = self.levels
+        if self.record:
+            now = monotonic_ns()
+            for pin, value in zip(pins, values):
+                if levels.get(pin) != value:
+                    self.times.append(now)
+                    self.pins.append(pin)
+                    self.values.append(value)
+                levels[pin] = value
+        else:
+            for pin, value in zip(pins, values):
+                levels[pin] = value
+
+    def transitions(self):
+        """
+        :return: iterator of (monotonic_ns timestamp, pin, value) for every recorded transition
+        """
+        return zip(self.times, self.pins, self.values)
+
+    def clear(self):
+        """
+        Forgets the recorded transitions, pin levels are kept
+        :return: nil
+        """
+        del self.times[:]
+        del self.pins[:]
+        del self.values[:]
+
+
+BACKENDS = {
+    NullGPIOBackend.name: NullGPIOBackend,
+    RPiGPIOBackend.name: RPiGPIOBackend,
+    GPIOMemBackend.name: GPIOMemBackend,
+    SimulatedGPIOBackend.name: SimulatedGPIOBackend,
+}
+
+
+def create_backend(name=None):
+    """
+    Creates a backend by name
+    :param name: 'rpi', 'mem', 'sim' or 'null'; None picks rpi when the GPIO library is installed and null otherwise
+    :return: GPIOBackend
+    """
+    if name is None:
+        name = RPiGPIOBackend.name if gpio_present else NullGPIOBackend.name
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError('Unknown GPIO backend {0}, expected one of {1}'.format(name, ', '.join(sorted(BACKENDS))))
+
+
+def self_test():
+    """
+    Checks GPIOMemBackend's register writes against an anonymous mapping standing in for /dev/gpiomem
+    :return: list of failed checks, empty if all passed
+    """
+    failures = []
+    block = mmap.mmap(-1, GPIOMemBackend.BLOCK_SIZE)
+    backend = GPIOMemBackend(block=block)
+    regs = memoryview(block).cast('I')
+
+    def check(name, value, expected):
+        if value != expected:
+            failures.append('{0}: {1:#x}, expected {2:#x}'.format(name, value, expected))
+
+    backend.setup([2, 3, 17, 40])
+    check('GPFSEL0', regs[0], (1 << 6) | (1 << 9))
+    check('GPFSEL1', regs[1], 1 << 21)
+    check('GPFSEL4', regs[4], 1)
+    backend.output_masks((1 << 2) | (1 << 17) | (1 << 40), 1 << 3)
+    check('GPSET0', regs[7], (1 << 2) | (1 << 17))
+    check('GPCLR0', regs[10], 1 << 3)
+    check('GPSET1', regs[8], 1 << 8)
+    backend.output([40], [0])
+    check('GPCLR1', regs[11], 1 << 8)
+    backend.cleanup()
+    check('GPCLR0 after cleanup', regs[10], (1 << 2) | (1 << 3) | (1 << 17))
+    check('GPFSEL0 after cleanup', regs[0], 0)
+    check('GPFSEL1 after cleanup', regs[1], 0)
+    check('GPFSEL4 after cleanup', regs[4], 0)
+    regs.release()
+    block.close()
+    return failures
+
+if __name__ == '__main__':
+    problems = self_test()
+    for problem in problems:
+        print(problem)
+    print('GPIOMemBackend self-test {0}'.format('failed' if problems else 'passed'))
+    sys.exit(1 if problems else 0)
@@ -1,51 +1,66 @@
 """
 This module includes the classes for GPIO Fire channel control on a Raspberry Pi
-GPIOFireChannel describes one channel and provides on-time checking and shutdown
-GPIOFireBank describes a collection of GPIOFireChannel objects and runs a thread that checks each that it has
-not been on for too long.
+GPIOFireBank manages a bank of channels and enforces that none is on for too long. Channel state is held in
+compact form: a bit mask of which channels are on (bit 0 is channel 1) plus parallel arrays of activation
+times, max on times and GPIO pins, so sweeps, diffs and snapshots work on the whole bank at once. Only
+channels whose state changes are written, and all of them with one call to the bank's GPIOBackend.
+GPIOFireChannel is a view of one channel of a bank.
 """
 import threading
-from time import time
-
-__author__ = 'Stu D\'alessandro'
+from array import array
+from time import monotonic, monotonic_ns
 
+from GPIOBackend import create_backend
 
-# Install Raspberry Pi GPIO class
-gpio_present = True
-try:
-    import RPi.GPIO as GPIO
-except ImportError:
-    print("Unable to import the Raspberry Pi GPIO library")
-    gpio_present = False
+__author__ = 'Stu D\'alessandro'
 
 max_channels = 24
 
 
-class GPIOFireChannel:
-    """ Manages one channel and timeouts"""
-    def __init__(self, channel_num=0, channel_offset=2, max_on_time=3):
+class GPIOFireChannel(object):
+    """ View of one channel of a GPIOFireBank. The state lives in the bank's arrays; this keeps the per-channel
+    interface for code that works with one channel at a time """
+    __slots__ = ('bank', 'index')
+
+    def __init__(self, bank, index):
         """
-        Sets channel defaults
-        :param channel_num: GPIO channel number
-        :param max_on_time: maximum time to allow the output to be turned on
-        :return: channel number
+        :param bank: the GPIOFireBank holding the channel's state
+        :param index: 0-based channel index in the bank
+        :return: nil
         """
-        self.cur_state = 0
-        self.activated_at = 0  # the date time when this channel was activated
-        self.gpio_channel = 0  # do nothing
-        self.set_gpio_channel(channel_num)
-        self.channel_offset = channel_offset
-        self.max_on_time = float(max_on_time)
-        self.set_state()
+        self.bank = bank
+        self.index = index
+
+    @property
+    def cur_state(self):
+        return (self.bank.state_mask >> self.index) & 1
+
+    @property
+    def activated_at(self):
+        """ monotonic time when this channel was activated, 0 while off """
+        return self.bank.activated_at[self.index]
+
+    @property
+    def gpio_channel(self):
+        """ 1-based GPIO channel number """
+        return self.bank.pins[self.index] - self.bank.channel_offset + 1
+
+    @property
+    def channel_offset(self):
+        return self.bank.channel_offset
+
+    @property
+    def max_on_time(self):
+        return self.bank.max_on_times[self.index]
 
     def set_gpio_channel(self, channel_num):
         """
-        Sets teh GPIO channel number to be managed by this object
+        Sets the GPIO channel number to be managed by this object
         :param channel_num: GPIO channel number, 1-based
         :return: channel number
         """
         if channel_num > 0:
-            self.gpio_channel = channel_num
+            self.bank.pins[self.index] = channel_num - 1 + self.bank.channel_offset
         return self.gpio_channel
 
     def set_max_on_time(self, new_max_time=3):
@@ -54,8 +69,7 @@ class GPIOFireChannel:
         :param new_max_time: max on time in seconds for this channel
         :return: new max on time
         """
-        self.max_on_time = float(new_max_time)
-        return self.max_on_time
+        return self.bank.set_channel_max_on_time(self.index + 1, new_max_time)
 
     def set_state(self, new_state=0):
         """
@@ -63,17 +77,7 @@ class GPIOFireChannel:
         :param new_state: 0 or 1
         :return: current state
         """
-        self.cur_state = new_state
-
-        # set or clear the activation time
-        if self.cur_state > 0:
-            self.activated_at = time()
-        else:
-            self.activated_at = 0
-
-        if gpio_present:
-            GPIO.output(self.gpio_channel - 1 + self.channel_offset, self.cur_state)
-
+        self.bank.set_channel_state(self.index + 1, new_state)
         return self.cur_state
 
     def assert_max_time(self):
@@ -81,38 +85,185 @@ class GPIOFireChannel:
         Checks how long this channel has been on and turns it off if time has expired
         :return: state of this channel after this call
         """
-        if self.activated_at > 0:
-            now = time()
-            if (now - self.activated_at) > self.max_on_time:
-                self.set_state(0)
+        self.bank.expire(1 << self.index)
         return self.cur_state
 
 
 class GPIOFireBank:
     """ Manages turning multiple rPI GPIO channels on and off.
     This class also enforces a maximum on-time for all channels """
-    def __init__(self, num_channels=24, max_on_time=3):
+    def __init__(self, num_channels=24, max_on_time=3, backend=None):
         """
         :param num_channels: total number of channels to manage
         :param max_on_time: The maximum time that any channel may be on for
+        :param backend: GPIOBackend that drives the pins, created from what is installed if None
         :return: nil
         """
         self.channel_offset = 2  # Added to channel number to map to first used GPIO channel
 
         # Configure GPIO interface
-        if gpio_present:
-            GPIO.setmode(GPIO.BCM)  # GPIO.BCM for IO pins, GPIO.BOARD for connector pins
-            GPIO.setwarnings(False)
-            for ch in range(0, num_channels):
-                GPIO.setup(ch + self.channel_offset, GPIO.OUT)
-
-        self.num_channels = 0
-        self.max_on_time = max_on_time
-        self.channels = []
-        for i in range(num_channels):
-            ch = GPIOFireChannel(i, self.max_on_time)
-            self.channels.append(ch)
-            self.num_channels += 1
+        self.backend = backend if backend is not None else create_backend()
+        self.backend.setup([ch + self.channel_offset for ch in range(0, num_channels)])
+
+        self.num_channels = num_channels
+        self.max_on_time = float(max_on_time)
+        self.all_mask = (1 << self.num_channels) - 1
+        self.state_mask = 0  # bit n set while channel n + 1 is on
+        self.activated_at = array('d', [0.0]) * num_channels  # monotonic activation time, 0 while off
+        self.max_on_times = array('d', [self.max_on_time]) * num_channels
+        self.on_times = array('d', [0.0]) * num_channels  # seconds on, up to the last time turned off
+        self.activations = array('Q', [0]) * num_channels  # times turned on
+        self.expirations = array('Q', [0]) * num_channels  # times forced off by the watchdog
+        self.uniform_max_on_time = True  # every entry of max_on_times equals max_on_time
+        self.pins = array('H', range(self.channel_offset, self.channel_offset + num_channels))
+        self.channels = [GPIOFireChannel(self, i) for i in range(num_channels)]
+        self.backend.output(list(self.pins), [0] * num_channels)
+        self.lock = threading.RLock()  # the watchdog thread switches channels too
+        self.watchdog = None  # told the deadline of every channel that is turned on
+        self.pulse_generation = 0  # bumped by kill() to cancel pulses still running
+        self.last_write_ns = 0  # monotonic_ns just after the pins were last written
+        self.forced_offs = 0  # channels turned off by the watchdog so far
+        self.fuel = None  # FuelModel told of every change, and asked before channels are opened
+
+    def set_watchdog(self, watchdog):
+        """
+        Attaches the watchdog that enforces max on time. Channels that are already on are reported to it.
+        :param watchdog: object with a schedule(deadline, mask) method, e.g. NaggingMother
+        :return: nil
+        """
+        with self.lock:
+            self.watchdog = watchdog
+            self._schedule(self.state_mask)
+
+    def set_fuel_model(self, model):
+        """
+        Attaches a fuel model, which then follows every change of state and may refuse openings
+        :param model: FuelModel for this bank's channels, or None to detach
+        :return: nil
+        """
+        with self.lock:
+            self.fuel = model
+            if model is not None:
+                now = monotonic()
+                model.reset(now)
+                model.sync(now, self.state_mask)
+
+    def _schedule(self, mask):
+        """
+        Reports the max on time deadlines of the channels in mask to the watchdog
+        :param mask: channels that were just turned on
+        :return: nil
+        """
+        watchdog = self.watchdog
+        if watchdog is None or mask == 0:
+            return
+        deadlines = {}
+        activated_at = self.activated_at
+        max_on_times = self.max_on_times
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            i = low.bit_length() - 1
+            deadline = activated_at[i] + max_on_times[i]
+            deadlines[deadline] = deadlines.get(deadline, 0) | low
+        for deadline, bits in deadlines.items():
+            watchdog.schedule(deadline, bits)
+
+    def set_mask(self, mask):
+        """
+        Sets the state of every channel at once. Only channels whose state changes are touched, and their
+        GPIO pins are all written in a single call so they switch together. Channels that stay on keep their
+        original activation time, so repeating a frame does not extend the max on time. An attached fuel
+        model may refuse the channels the frame opens.
+        :param mask: bit n set to turn channel n + 1 on, clear to turn it off
+        :return: the new state mask
+        """
+        with self.lock:
+            return self._set_mask(mask & self.all_mask)
+
+    def _set_mask(self, mask):
+        diff = mask ^ self.state_mask
+        if diff == 0:
+            return mask
+
+        now = monotonic()
+        fuel = self.fuel
+        if fuel is not None:
+            if diff & mask:
+                mask = fuel.admit(self.state_mask, mask, now)
+                diff = mask ^ self.state_mask
+                if diff == 0:
+                    return mask
+            fuel.update(now, diff, mask)
+        turned_on = diff & mask
+        activated_at = self.activated_at
+        all_pins = self.pins
+        pins_on = 0
+        pins_off = 0
+        while diff:
+            low = diff & -diff
+            i = low.bit_length() - 1
+            diff ^= low
+            if mask & low:
+                activated_at[i] = now
+                self.activations[i] += 1
+                pins_on |= 1 << all_pins[i]
+            else:
+                self.on_times[i] += now - activated_at[i]
+                activated_at[i] = 0.0
+                pins_off |= 1 << all_pins[i]
+
+        self.state_mask = mask
+        self.backend.output_masks(pins_on, pins_off)
+        self.last_write_ns = monotonic_ns()
+        if turned_on and self.watchdog is not None:
+            if self.uniform_max_on_time:
+                self.watchdog.schedule(now + self.max_on_time, turned_on)
+            else:
+                self._schedule(turned_on)
+        return mask
+
+    def get_mask(self):
+        """
+        :return: current state of every channel as a bit mask, bit 0 is channel 1
+        """
+        return self.state_mask
+
+    def snapshot(self):
+        """
+        :return: (state mask, copy of the activation time array), taken atomically
+        """
+        with self.lock:
+            return self.state_mask, array('d', self.activated_at)
+
+    def usage(self):
+        """
+        :return: (cumulative seconds on, activation counts, watchdog forced-off counts) per channel, copied
+        atomically; on time includes channels that are on now
+        """
+        with self.lock:
+            now = monotonic()
+            on_times = array('d', self.on_times)
+            activated_at = self.activated_at
+            mask = self.state_mask
+            while mask:
+                low = mask & -mask
+                mask ^= low
+                i = low.bit_length() - 1
+                on_times[i] += now - activated_at[i]
+            return on_times, array('Q', self.activations), array('Q', self.expirations)
+
+    def set_states(self, states):
+        """
+        Sets the state of every channel from a state vector, see set_mask
+        :param states: sequence of 0/1 values, the first is channel 1
+        :return: the new state mask
+        """
+        mask = 0
+        for i, state in enumerate(states):
+            if state:
+                mask |= 1 << i
+        return self.set_mask(mask)
 
     def set_channel_state(self, channel_num, state):
         """
@@ -122,26 +273,64 @@ class GPIOFireBank:
         :return: channel number or False
         """
         result = False
-        if channel_num <= self.num_channels:
-            self.channels[channel_num].set_state(state)
+        if 0 < channel_num <= self.num_channels:
+            bit = 1 << (channel_num - 1)
+            self.set_mask(self.state_mask | bit if state else self.state_mask & ~bit)
             result = channel_num
         return result
 
     def kill(self):
         """
-        Turn all channels off
+        Turn all channels off, cancelling any pulses
         :return: nil
         """
-        for channel in self.channels:
-            channel.set_state(0)
+        with self.lock:
+            self.pulse_generation += 1
+            self.set_mask(0)
+
+    def pulse(self, mask, duration, count=1, gap=0.0):
+        """
+        Opens the channels in mask now and closes them duration seconds later, repeating count times with gap
+        seconds between pulses. Edges are timed by the watchdog, so max on time still applies to every pulse.
+        :param mask: channels to pulse, bit 0 is channel 1
+        :param duration: seconds each pulse stays open
+        :param count: number of pulses
+        :param gap: seconds closed between pulses
+        :return: False if there is no watchdog to time the pulse
+        """
+        if self.watchdog is None:
+            return False
+        with self.lock:
+            start = monotonic()
+            self._pulse_edge(mask & self.all_mask, start, duration, duration + gap, max(1, count), 0, True,
+                             self.pulse_generation)
+        return True
+
+    def _pulse_edge(self, mask, start, duration, period, count, number, opening, generation):
+        """
+        Applies one edge of a pulse train and schedules the next. Edge times are computed from the start of
+        the train so they do not drift.
+        """
+        watchdog = self.watchdog
+        with self.lock:
+            if generation != self.pulse_generation or watchdog is None:
+                return
+            if opening:
+                self._set_mask(self.state_mask | mask)
+                watchdog.call_at(start + number * period + duration, self._pulse_edge,
+                                 mask, start, duration, period, count, number, False, generation)
+            else:
+                self._set_mask(self.state_mask & ~mask)
+                if number + 1 < count:
+                    watchdog.call_at(start + (number + 1) * period, self._pulse_edge,
+                                     mask, start, duration, period, count, number + 1, True, generation)
 
     def blow(self):
         """
         Turn all channels on (max on time applies)
         :return: nil
         """
-        for channel in self.channels:
-            channel.set_state(1)
+        self.set_mask(self.all_mask)
 
     def set_max_on_time(self, new_max_time):
         """
@@ -149,14 +338,56 @@ class GPIOFireBank:
         :param new_max_time: new max on time in seconds
         :return: new max on time
         """
-        for channel in self.channels:
-            channel.set_max_on_time(new_max_time)
+        with self.lock:
+            self.max_on_time = float(new_max_time)
+            self.max_on_times = array('d', [self.max_on_time]) * self.num_channels
+            self.uniform_max_on_time = True
+            self._schedule(self.state_mask)
         return new_max_time
 
+    def set_channel_max_on_time(self, channel_num, new_max_time):
+        """
+        Updates the max on time of one channel
+        :param channel_num: 1-based, from 1 to self.num_channels
+        :param new_max_time: max on time in seconds for this channel
+        :return: new max on time, or False if there is no such channel
+        """
+        if not 0 < channel_num <= self.num_channels:
+            return False
+        with self.lock:
+            self.max_on_times[channel_num - 1] = float(new_max_time)
+            self.uniform_max_on_time = False
+            self._schedule(self.state_mask & (1 << (channel_num - 1)))
+        return float(new_max_time)
+
     def assert_max_on_time(self):
         """
         Checks all channels for max on time, forcing off if they exceed this time
         :return: nil
         """
-        for channel in self.channels:
-            channel.assert_max_time()
+        self.expire(self.state_mask)
+
+    def expire(self, mask):
+        """
+        Forces off the channels in mask whose max on time has run out. Channels that are off, or were turned
+        on again since their deadline was scheduled, are left alone.
+        :param mask: channels to check
+        :return: mask of the channels that were forced off
+        """
+        with self.lock:
+            mask &= self.state_mask
+            expired = 0
+            now = monotonic()
+            activated_at = self.activated_at
+            max_on_times = self.max_on_times
+            while mask:
+                low = mask & -mask
+                mask ^= low
+                i = low.bit_length() - 1
+                if now >= activated_at[i] + max_on_times[i]:
+                    expired |= low
+                    self.expirations[i] += 1
+            if expired:
+                self._set_mask(self.state_mask & ~expired)
+                self.forced_offs += bin(expired).count('1')
+            return expired
@@ -1,26 +1,114 @@
 """
-Checks the max timeout on a bank periodically
+Enforces the max on time of a bank's channels and runs the bank's other timed actions
 """
 
-from time import sleep
+import threading
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+import PuffLog
+import RealTime
+from PrecisionTimer import SPIN, spin_until
 
 __author__ = 'Stu D\'Alessandro'
 
 
 class NaggingMother(object):
     """
-    Does something every half second until something comes over a queue
+    Turns channels off when their max on time runs out. The bank reports the deadline of every channel it turns
+    on through schedule(), and timed actions such as the edges of a pulse are added with call_at(). Everything
+    is kept in one min-heap; the thread sleeps until the earliest deadline, or indefinitely while there is none,
+    and spins the last moments before a timed action so its edge is on time. It stops when something comes over
+    the queue and wake() is called.
     """
-    def __init__(self):
+    def __init__(self, spin=SPIN):
+        """
+        :param spin: seconds before a timed action at which the thread stops sleeping and spins
+        :return: nil
+        """
         self.q = None
         self.bank = None
+        self.spin = spin
+        self.deadlines = []  # heap of (monotonic deadline, sequence, callback or None, mask or args)
+        self.sequence = count()
+        self.cond = threading.Condition()
+
+    def schedule(self, deadline, mask):
+        """
+        Asks for the channels in mask to be checked at deadline
+        :param deadline: monotonic time at which the channels must be off
+        :param mask: bank channel mask
+        :return: nil
+        """
+        self._push((deadline, next(self.sequence), None, mask))
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Runs callback(*args) on the watchdog thread at deadline. An exception from the callback is logged and
+        the watchdog carries on.
+        :param deadline: monotonic time
+        :param callback: callable, must not block
+        :return: nil
+        """
+        self._push((deadline, next(self.sequence), callback, args))
+
+    def _push(self, entry):
+        with self.cond:
+            heappush(self.deadlines, entry)
+            if self.deadlines[0] is entry:
+                self.cond.notify()
+
+    def wake(self):
+        """
+        Wakes the thread so it notices a message on the queue
+        :return: nil
+        """
+        with self.cond:
+            self.cond.notify()
 
     def __call__(self, bank, event_queue):
         self.bank = bank
         self.q = event_queue
+        RealTime.enter('watchdog')
+        bank.set_watchdog(self)
 
+        deadlines = self.deadlines
         while True:
-            if self.q.empty() is False:
-                break
-            self.bank.assert_max_on_time()
-            sleep(0.5)
+            with self.cond:
+                while True:
+                    if self.q.empty() is False:
+                        bank.watchdog = None
+                        return
+                    if deadlines:
+                        deadline = deadlines[0][0]
+                        # only timed actions such as pulse edges need spinning for; a max on time check is
+                        # fine a scheduler tick late, and spinning for it would burn a core on a busy bank
+                        spin = self.spin if deadlines[0][2] is not None else 0.0
+                        timeout = deadline - monotonic()
+                        if timeout <= spin:
+                            break
+                        timeout -= spin
+                    else:
+                        timeout = None
+                    self.cond.wait(timeout)
+
+            now = spin_until(deadline)
+            due = 0
+            actions = []
+            with self.cond:
+                while deadlines and deadlines[0][0] <= now:
+                    entry = heappop(deadlines)
+                    if entry[2] is None:
+                        due |= entry[3]
+                    else:
+                        actions.append(entry)
+            if due:
+                self.bank.expire(due)
+            for entry in actions:
+                # one bad action must not stop max on time enforcement for the rest of the run
+                try:
+                    entry[2](*entry[3])
+                except Exception as e:
+                    PuffLog.error('watchdog_action_failed', action=getattr(entry[2], '__qualname__', entry[2]),
+                                  error=repr(e))
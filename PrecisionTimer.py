@@ -0,0 +1,35 @@
+"""
+High precision waits on the monotonic clock.
+The OS sleep is only accurate to a millisecond or so, so waits sleep coarsely until SPIN seconds before the
+deadline and then spin on the clock for the rest. The spin costs CPU for at most SPIN seconds per edge.
+"""
+from time import monotonic, sleep
+
+__author__ = 'Stu D\'Alessandro'
+
+SPIN = 0.002  # seconds before a deadline at which waits stop sleeping and start spinning
+
+
+def spin_until(deadline):
+    """
+    Busy waits until deadline
+    :param deadline: monotonic time
+    :return: monotonic time at which the wait ended
+    """
+    now = monotonic()
+    while now < deadline:
+        now = monotonic()
+    return now
+
+
+def sleep_until(deadline, spin=SPIN):
+    """
+    Sleeps until close to deadline, then spins the rest of the way
+    :param deadline: monotonic time
+    :param spin: seconds to spin rather than sleep
+    :return: monotonic time at which the wait ended
+    """
+    remaining = deadline - monotonic()
+    if remaining > spin:
+        sleep(remaining - spin)
+    return spin_until(deadline)
@@ -1,11 +1,25 @@
 """ This is the main module for Puff - which receives commands over Ethernet and turns cannon channels on or off """
 
 from GPIOFireBank import GPIOFireChannel, GPIOFireBank
-from socket import *
+from GPIOBackend import create_backend
+from PuffServer import PuffServer
+from PuffOutput import CommandQueue, POLICIES
+from socket import gethostbyname, gethostname
 from time import sleep
 from NaggingMother import NaggingMother
+from ShowPlayer import ShowPlayer
+from ShowFile import ShowFile
+from ShowValidator import validate
+from FuelModel import load_fuel_model, simulate
+from PuffMacros import MacroPlayer, load_macros
+from PuffPatterns import PatternPlayer, parse_effect
+from ClockSync import ClockLeader, ClockFollower
+from PuffMetrics import PuffMetrics
+from PuffMetricsHTTP import MetricsHTTPServer
+import PuffLog
+import RealTime
 import threading
-from Queue import Queue
+from queue import Queue
 import sys, getopt
 
 __author__ = 'Stu D\'Alessandro'
@@ -19,90 +33,209 @@ def main(argv):
     host = ''
     port = 4444
     bufsize = 1024
-    addr = (host, port)
     local_addr = gethostbyname(gethostname())
-    running = True # keep running until this is set false
     num_channels = 18
-
-    test_toggle = False
+    udp_port = None
+    backend_name = None  # pick from what is installed
+    show_path = None
+    clock_port = None  # lead the cluster clock on this UDP port
+    leader_addr = None  # follow the cluster clock of this node
+    metrics_interval = 10.0  # seconds between latency summaries, 0 for none
+    metrics_port = None  # serve Prometheus metrics over HTTP on this port
+    log_path = None  # log to stdout
+    queue_policy = 'coalesce'  # what gives when the command queue is full
+    realtime = None  # (cpu or None, SCHED_FIFO priority) for the timing threads
+    macro_path = None
+    fuel_path = None  # fuel and pressure model of the bank's accumulator
+    effect_spec = None  # ambient effect played from startup, name[:param...][@rate]
 
     # process command line arguments
     try:
-        opts, args = getopt.getopt(argv, 'a:p:c:')
+        opts, args = getopt.getopt(argv, 'a:p:c:u:b:s:L:F:m:M:l:q:R:x:f:e:')
     except getopt.GetoptError:
-        print 'Usage puff -a 192.168.1.144 -p 4444 -c 24'
+        print('Usage puff -a 192.168.1.144 -p 4444 -c 24 [-u 4445] [-b rpi|mem|sim|null] [-s show.puff] [-L 4446 | -F leader:4446] [-m 10] [-M 9464] [-l puff.log] [-q coalesce|drop-oldest|reject] [-R cpu[:priority] | -R any[:priority]] [-x macros.txt] [-f fuel.txt] [-e wave:20:50:1@20]')
         sys.exit(2)
 
     for opt, arg in opts:
         if opt == '-a':
             host = arg
             local_addr = arg
-            print 'Using host address {0}'.format(host)
+            print('Using host address {0}'.format(host))
         elif opt == '-p':
             port = int(arg)
-            print 'Using host port {0}'.format(port)
+            print('Using host port {0}'.format(port))
         elif opt == '-c':
             num_channels = int(arg)
-            print 'Number of channels set to {0)'.format(num_channels)
+            print('Number of channels set to {0}'.format(num_channels))
+        elif opt == '-u':
+            udp_port = int(arg)
+            print('Accepting UDP commands on port {0}'.format(udp_port))
+        elif opt == '-b':
+            backend_name = arg
+            print('Using the {0} GPIO backend'.format(backend_name))
+        elif opt == '-s':
+            show_path = arg
+        elif opt == '-L':
+            clock_port = int(arg)
+            print('Leading the cluster clock on port {0}'.format(clock_port))
+        elif opt == '-F':
+            leader_host, leader_port = arg.rsplit(':', 1)
+            leader_addr = (leader_host, int(leader_port))
+            print('Following the cluster clock at {0}'.format(arg))
+        elif opt == '-m':
+            metrics_interval = float(arg)
+        elif opt == '-M':
+            metrics_port = int(arg)
+            print('Serving metrics over HTTP on port {0}'.format(metrics_port))
+        elif opt == '-l':
+            log_path = arg
+            print('Logging to {0}'.format(log_path))
+        elif opt == '-q':
+            queue_policy = arg
+            if queue_policy not in POLICIES:
+                print('Queue policy must be one of {0}'.format(', '.join(POLICIES)))
+                sys.exit(2)
+            print('Full command queue policy: {0}'.format(queue_policy))
+        elif opt == '-x':
+            macro_path = arg
+        elif opt == '-f':
+            fuel_path = arg
+        elif opt == '-e':
+            effect_spec = arg
+        elif opt == '-R':
+            cpu, _, priority = arg.partition(':')
+            realtime = (None if cpu == 'any' else int(cpu), int(priority) if priority else 50)
+            print('Real-time mode on core {0}, priority {1}'.format(cpu, realtime[1]))
+    effect = None
+    if effect_spec is not None:
+        try:
+            effect, rate = parse_effect(effect_spec, num_channels)
+        except ValueError as e:
+            print('Bad effect {0}: {1}'.format(effect_spec, e))
+            sys.exit(2)
+    fuel = None
+    if fuel_path is not None:
+        try:
+            fuel = load_fuel_model(fuel_path, num_channels)
+        except (IOError, ValueError) as e:
+            print('Unable to load fuel model: {0}'.format(e))
+            sys.exit(2)
+    addr = (host, port)
+    PuffLog.start(log_path)
+    if realtime is not None:
+        # before any timing thread starts, they set themselves up as they start
+        locked = RealTime.configure(realtime[0], realtime[1])['memory_locked']
+        print('Memory {0}'.format('locked' if locked else 'not locked, mlockall was not permitted'))
+    udp_addr = (host, udp_port) if udp_port is not None else None
 
     # Set up fire banks
-    banks = GPIOFireBank(num_channels)
+    try:
+        backend = create_backend(backend_name)
+    except (ValueError, RuntimeError) as e:
+        print(e)
+        sys.exit(2)
+    banks = GPIOFireBank(num_channels, backend=backend)
 
     # TODO: testing only, remove!
     banks.blow()
     sleep(1)
     banks.kill()
 
-    # setup watchdog on fire bank
+    # fuel use and accumulator pressure follow every change of the bank, and may refuse openings
+    if fuel is not None:
+        banks.set_fuel_model(fuel)
+        print('Loaded fuel model {0}'.format(fuel_path))
+
+    # shows are uploaded over the network and played locally
+    player = ShowPlayer(banks)
+    if show_path is not None:
+        try:
+            show = ShowFile(show_path)
+        except (IOError, ValueError) as e:
+            print('Unable to load show: {0}'.format(e))
+            sys.exit(2)
+        report = validate(show, banks.num_channels, banks.max_on_time)
+        if not report.ok():
+            print('Show {0} does not fit this bank:'.format(show_path))
+            print(report.summary())
+            sys.exit(2)
+        player.load(show)
+        print('Loaded show {0}, {1} cues, {2:.1f} s'.format(show_path, len(show), show.duration()))
+        if fuel is not None:
+            budget = simulate(fuel.copy(), show)
+            print('Show uses {0:.1f} units of fuel, lowest pressure {1:.1f} psi, {2} openings refused'.format(
+                budget.used, budget.low_pressure, budget.refused))
+
+    # macros are defined from a file or over the network and timed by the watchdog
+    macros = MacroPlayer(banks)
+    if macro_path is not None:
+        try:
+            for macro in load_macros(macro_path).values():
+                macros.define(macro)
+        except (IOError, ValueError) as e:
+            print('Unable to load macros: {0}'.format(e))
+            sys.exit(2)
+        print('Loaded macros {0}'.format(', '.join(sorted(macros.macros))))
+
+    # setup watchdog on fire bank, once nothing above can exit for a bad file
     mom = NaggingMother()
     call_your_mother = Queue(16)
     watchdog = threading.Thread(target=mom, args=(banks, call_your_mother))
     watchdog.start()
 
-    # Open socket
-    ss = socket(AF_INET, SOCK_STREAM)
-    ss.bind(addr)
-    while running:
-        ss.listen(1)
-        print "Listening on host {0}, port {1}".format(local_addr, port)
-        try:
-            cs, addr = ss.accept()  # blocking
-        except (KeyboardInterrupt, SystemExit):
-            break
-        print 'Connected from client at addr'
-        while True:
-            try:
-                mssg = cs.recv(bufsize)
-            except error:
-                print "Lost connection to host process. Waiting for new connection..."
-                banks.kill()
-                break
-            except (KeyboardInterrupt, SystemExit):
-                running = False
-                break
-            if not mssg:
-                print "Null data received. Stopping program."
-                banks.kill()
-                running = False
-                break
-            else:
-                # TODO: testing only...
-                print "Message: {0}".format(mssg)
-
-            # TODO: testing only. Replace with message processing
-            cs.send(mssg)
-            if test_toggle:
-                banks.blow()
-            else:
-                banks.kill()
-            test_toggle = not test_toggle
-        cs.close()
-    ss.close()
+    # effects are generated a frame per tick on their own thread, started here or over the network
+    patterns = PatternPlayer(banks)
+    if effect is not None:
+        patterns.play(effect, rate)
+        print('Playing effect {0}'.format(effect_spec))
+
+    # shows on several nodes start together at a time on the leader's clock
+    clock = None
+    if clock_port is not None:
+        clock = ClockLeader((host, clock_port))
+    elif leader_addr is not None:
+        clock = ClockFollower(leader_addr)
+
+    # time every command from receive to GPIO write, summarized every metrics_interval seconds
+    metrics = PuffMetrics(banks)
+    if metrics_interval > 0:
+        metrics.report_every(metrics_interval)
+
+    # clients are served from one event loop that queues their commands; an output thread runs them
+    server = PuffServer(banks, addr, bufsize, udp_addr, player, clock, metrics, CommandQueue(policy=queue_policy),
+                        macros, patterns)
+    if realtime is not None:
+        buffers = [histogram.counts for histogram in metrics.current.values()]
+        if server.datagrams is not None:
+            buffers.append(server.datagrams.buf)
+        RealTime.prefault(*buffers)
+        jitter = RealTime.measure_jitter(500, spin=0)
+        print('Timer wakeup lateness, sleeping: p50 {p50_us} us, p99 {p99_us} us, max {max_us} us'.format(**jitter))
+        jitter = RealTime.measure_jitter(500)
+        print('Timer wakeup lateness, spinning: p50 {p50_us} us, p99 {p99_us} us, max {max_us} us'.format(**jitter))
+
+    exporter = None
+    if metrics_port is not None:
+        exporter = MetricsHTTPServer(metrics, banks, server, mom, (host, metrics_port))
+    print("Listening on host {0}, port {1}".format(local_addr, port))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        server.close()
+    player.close()
+    patterns.close()
+    if exporter is not None:
+        exporter.close()
+    if clock is not None:
+        clock.close()
+    banks.kill()
 
     # shut down the watchdog thread
     call_your_mother.put('exit')
-    print "Shutting down..."
+    mom.wake()
+    PuffLog.info('shutting_down')
     watchdog.join()
+    PuffLog.close()
     return 0
 
 if __name__ == '__main__':
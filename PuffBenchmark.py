@@ -0,0 +1,149 @@
+"""
+Microbenchmarks for the bank and channel hot paths, run against the simulated GPIO backend.
+Reports operations per second and latency percentiles and optionally saves the results as JSON so runs can be
+compared over time.
+
+Usage: python PuffBenchmark.py [-n 20000] [-c 18,24,64,256] [-o results.json]
+"""
+import getopt
+import json
+import platform
+import sys
+from array import array
+from time import perf_counter_ns, time
+
+from GPIOBackend import SimulatedGPIOBackend
+from GPIOFireBank import GPIOFireBank
+
+__author__ = 'Stu D\'Alessandro'
+
+
+def percentile(sorted_samples, fraction):
+    """
+    :param sorted_samples: sorted sequence of samples
+    :param fraction: 0.0 to 1.0
+    :return: the sample at that fraction of the way through
+    """
+    if not sorted_samples:
+        return 0
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def measure(name, num_channels, iterations, operation):
+    """
+    Times operation(i) once per iteration
+    :param name: benchmark name
+    :param num_channels: channel count of the bank under test
+    :param iterations: number of calls
+    :param operation: callable taking the iteration number
+    :return: dict of results, latencies in microseconds
+    """
+    samples = array('q', bytes(8 * iterations))
+    for i in range(min(iterations, 1000)):  # warm up
+        operation(i)
+    start = perf_counter_ns()
+    for i in range(iterations):
+        t0 = perf_counter_ns()
+        operation(i)
+        samples[i] = perf_counter_ns() - t0
+    elapsed = perf_counter_ns() - start
+
+    ordered = sorted(samples)
+    return {
+        'name': name,
+        'channels': num_channels,
+        'iterations': iterations,
+        'ops_per_sec': iterations * 1e9 / elapsed if elapsed else 0.0,
+        'mean_us': sum(ordered) / 1000.0 / iterations,
+        'p50_us': percentile(ordered, 0.50) / 1000.0,
+        'p90_us': percentile(ordered, 0.90) / 1000.0,
+        'p99_us': percentile(ordered, 0.99) / 1000.0,
+        'p999_us': percentile(ordered, 0.999) / 1000.0,
+        'max_us': ordered[-1] / 1000.0,
+    }
+
+
+def bench_bank(num_channels, iterations):
+    """
+    Runs every benchmark against one bank size
+    :param num_channels: channels in the bank
+    :param iterations: calls per benchmark
+    :return: list of result dicts
+    """
+    bank = GPIOFireBank(num_channels, max_on_time=3600, backend=SimulatedGPIOBackend(record=False))
+    channel = bank.channels[0]
+    all_mask = bank.all_mask
+    # alternating checkerboard frames change every channel on every call
+    frames = (all_mask & 0x5555555555555555555555555555555555555555555555555555555555555555,
+              all_mask & 0xAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA)
+    results = []
+
+    results.append(measure('channel_set_state', num_channels, iterations,
+                           lambda i: channel.set_state(i & 1)))
+    channel.set_state(0)
+    results.append(measure('bank_set_channel_state', num_channels, iterations,
+                           lambda i: bank.set_channel_state(1 + (i >> 1) % num_channels, i & 1)))
+    bank.kill()
+    results.append(measure('bank_set_mask_frame', num_channels, iterations,
+                           lambda i: bank.set_mask(frames[i & 1])))
+    results.append(measure('bank_blow_kill', num_channels, iterations,
+                           lambda i: bank.kill() if i & 1 else bank.blow()))
+
+    bank.blow()  # every channel on and nothing expired: the full cost of checking without switching
+    results.append(measure('watchdog_sweep_all_on', num_channels, iterations,
+                           lambda i: bank.assert_max_on_time()))
+    bank.kill()
+    results.append(measure('watchdog_sweep_all_off', num_channels, iterations,
+                           lambda i: bank.assert_max_on_time()))
+    return results
+
+
+def main(argv):
+    """
+    Runs the benchmarks and prints a table
+    :return: 0
+    """
+    iterations = 20000
+    channel_counts = [18, 24, 64, 256]
+    output = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'n:c:o:')
+    except getopt.GetoptError:
+        print('Usage PuffBenchmark -n 20000 -c 18,24,64,256 -o results.json')
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-n':
+            iterations = int(arg)
+        elif opt == '-c':
+            channel_counts = [int(c) for c in arg.split(',')]
+        elif opt == '-o':
+            output = arg
+
+    results = []
+    print('{0:<26}{1:>6}{2:>14}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        'benchmark', 'chans', 'ops/sec', 'p50 us', 'p99 us', 'p99.9 us', 'max us'))
+    for num_channels in channel_counts:
+        for r in bench_bank(num_channels, iterations):
+            results.append(r)
+            print('{name:<26}{channels:>6}{ops_per_sec:>14.0f}{p50_us:>10.2f}{p99_us:>10.2f}{p999_us:>10.2f}'
+                  '{max_us:>10.2f}'.format(**r))
+
+    if output is not None:
+        report = {
+            'timestamp': time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'results': results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results saved to {0}'.format(output))
+    return 0
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,531 @@
+"""
+Cluster controller: drives several Puff nodes as one virtual bank.
+
+PuffCluster keeps a persistent TCP connection to every node and maps one global channel space onto them in
+order, e.g. four 18 channel nodes give channels 1-72. It has the same switching methods as GPIOFireBank, so a
+PuffServer can serve it to show software unchanged: every incoming frame is split into one OP_SET_MASK per
+node whose channels changed, and those are written to all nodes' sockets back to back without waiting for
+replies. Each node still enforces its own max on time.
+
+Show commands sent to the cluster are handled by ClusterPlayer: an upload is split into one show per node,
+and starting plays every node's show at the same moment on the first node's cluster clock (start_show_at).
+
+Usage: python PuffCluster.py -p 4444 -n 192.168.1.144:4444:18,192.168.1.145:4444:18 [-d 2]
+"""
+import getopt
+import selectors
+import socket
+import sys
+import threading
+from time import monotonic, monotonic_ns, sleep
+
+from PuffProtocol import CommandParser, ProtocolError, OP_CLOCK, OP_ERROR, encode, encode_set_mask, encode_kill_all, \
+    encode_set_max_on_time, encode_pulse_mask, encode_show, OP_CLOCK_QUERY, OP_SHOW_START_AT, OP_SHOW_STOP, \
+    OP_SHOW_PAUSE, OP_SHOW_SEEK
+import PuffLog
+from PuffServer import PuffServer
+from Show import Show
+from ShowPlayer import STOPPED, PLAYING, PAUSED
+
+MAX_NODE_CHANNELS = 64  # node frames are OP_SET_MASK, one 64 bit word
+
+__author__ = 'Stu D\'Alessandro'
+
+
+class ClusterNode(object):
+    """ One Puff node and the slice of the global channel space it owns """
+    def __init__(self, addr, first_channel, num_channels, max_backlog=65536):
+        """
+        :param addr: (host, port) of the node's Puff server
+        :param first_channel: 0-based global channel of the node's channel 1
+        :param num_channels: channels on the node
+        :param max_backlog: bytes of unsent frames tolerated before the connection is considered stalled
+        :return: nil
+        """
+        self.addr = addr
+        self.first_channel = first_channel
+        self.num_channels = num_channels
+        self.mask = ((1 << num_channels) - 1) << first_channel
+        self.max_backlog = max_backlog
+        self.sock = None
+        self.outbox = bytearray()
+        self.allowance = 0  # bytes of bulk frames still in the outbox, tolerated on top of max_backlog
+        self.sent_mask = None  # last state sent, None forces the next frame out
+        self.errors = 0
+        self.last_clock = None  # (leader ns, synchronized) from the last OP_CLOCK reply
+        self.parser = CommandParser(self.handle)
+
+    def handle(self, opcode, args):
+        if opcode == OP_ERROR:
+            self.errors += 1
+        elif opcode == OP_CLOCK:
+            self.last_clock = args
+
+    def connect(self, timeout=1.0):
+        """
+        Opens the connection
+        :return: True if connected
+        """
+        try:
+            sock = socket.create_connection(self.addr, timeout)
+        except OSError:
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.outbox = bytearray()
+        self.allowance = 0
+        self.sent_mask = None
+        self.parser.reset()
+        self.sock = sock
+        return True
+
+    def disconnect(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
+
+    def send(self, data):
+        """
+        Queues a frame and writes as much as the socket takes without blocking
+        :param data: frame bytes
+        :return: False if the node is not connected or has stalled
+        """
+        if self.sock is None:
+            return False
+        self.outbox += data
+        return self.flush()
+
+    def send_bulk(self, data):
+        """
+        Queues frames too large for the backlog, e.g. a show upload. What the socket does not take at once is
+        written by PuffCluster.maintain() as the node accepts it, so the caller never blocks.
+        :param data: frame bytes
+        :return: False if the node is not connected or has stalled
+        """
+        if self.sock is None:
+            return False
+        self.allowance += len(data)
+        return self.send(data)
+
+    def flush(self):
+        """
+        Writes as much of the outbox as the socket takes without blocking
+        :return: False if the node is not connected or has stalled
+        """
+        sock = self.sock
+        if sock is None:
+            return False
+        if self.outbox:
+            try:
+                sent = sock.send(self.outbox)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.disconnect()
+                return False
+            del self.outbox[:sent]
+            self.allowance = max(0, self.allowance - sent)
+        if len(self.outbox) > self.max_backlog + self.allowance:
+            self.disconnect()
+            return False
+        return True
+
+    def send_state(self, global_mask):
+        """
+        Sends this node's part of a global frame if it changed
+        :param global_mask: state of the whole cluster
+        :return: nil
+        """
+        local = (global_mask & self.mask) >> self.first_channel
+        if local != self.sent_mask and self.send(encode_set_mask(local)):
+            self.sent_mask = local
+
+
+class PuffCluster(object):
+    """ A virtual bank spread over several Puff nodes """
+    def __init__(self, nodes, max_on_time=3, retry_interval=1.0):
+        """
+        :param nodes: list of (host, port, num_channels), in global channel order
+        :param max_on_time: max on time reported to clients; nodes keep their own until set_max_on_time
+        :param retry_interval: seconds between reconnect attempts to a lost node
+        :return: nil
+        """
+        self.nodes = []
+        first = 0
+        for host, port, num_channels in nodes:
+            self.nodes.append(ClusterNode((host, port), first, num_channels))
+            first += num_channels
+        self.num_channels = first
+        self.all_mask = (1 << first) - 1
+        self.max_on_time = float(max_on_time)
+        self.max_on_time_set = False  # pushed to reconnecting nodes once set through the cluster
+        self.state_mask = 0
+        self.last_write_ns = 0  # monotonic_ns just after frames were last written to the nodes
+        self.forced_offs = 0  # each node's watchdog counts its own
+        self.retry_interval = retry_interval
+        self.pending_start = None  # (asked ns, delay, deadline, failed) while waiting for the first node's clock
+        self.lock = threading.RLock()
+        self.running = True
+
+        for node in self.nodes:
+            node.connect()
+        self.thread = threading.Thread(target=self.maintain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def maintain(self):
+        """
+        Thread body: reads replies from the nodes, writes the rest of bulk uploads, starts shows once the first
+        node's clock answers and reconnects lost nodes, bringing them up to date
+        :return: nil
+        """
+        selector = selectors.DefaultSelector()
+        registered = {}
+        next_retry = 0.0
+        while self.running:
+            pending = self.pending_start
+            if pending is not None:
+                if self.nodes[0].last_clock is not None:
+                    self._start_pending()
+                elif monotonic() > pending[2]:
+                    self._start_failed()
+
+            # follow connections that were lost or replaced, and watch for room on those with frames to write
+            for node in self.nodes:
+                sock = node.sock
+                events = selectors.EVENT_READ | selectors.EVENT_WRITE if node.outbox else selectors.EVENT_READ
+                if registered.get(node) is not sock:
+                    old = registered.pop(node, None)
+                    if old is not None:
+                        try:
+                            selector.unregister(old)
+                        except (KeyError, ValueError):
+                            pass
+                    if sock is not None:
+                        selector.register(sock, events, node)
+                        registered[node] = sock
+                elif sock is not None and selector.get_key(sock).events != events:
+                    selector.modify(sock, events, node)
+
+            if monotonic() >= next_retry:
+                next_retry = monotonic() + self.retry_interval
+                for node in self.nodes:
+                    if node.sock is None and node.connect():
+                        with self.lock:
+                            if self.max_on_time_set:
+                                node.send(encode_set_max_on_time(self.max_on_time))
+                            node.send_state(self.state_mask)
+
+            if not registered:
+                sleep(0.1)
+                continue
+            for key, events in selector.select(0.1):
+                node = key.data
+                if events & selectors.EVENT_WRITE:
+                    with self.lock:
+                        if node.sock is key.fileobj:
+                            node.flush()
+                if not events & selectors.EVENT_READ:
+                    continue
+                try:
+                    nbytes = node.parser.receive(key.fileobj)
+                except BlockingIOError:
+                    continue
+                except (OSError, ProtocolError):
+                    nbytes = 0
+                if nbytes == 0:
+                    with self.lock:
+                        if node.sock is key.fileobj:
+                            node.disconnect()
+                    continue
+                try:
+                    node.parser.drain()
+                except ProtocolError:
+                    with self.lock:
+                        if node.sock is key.fileobj:
+                            node.disconnect()
+        selector.close()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for node in self.nodes:
+            node.disconnect()
+
+    def set_mask(self, mask):
+        """
+        Sets the state of every channel in the cluster; only nodes whose channels change are sent a frame
+        :param mask: bit n set to turn global channel n + 1 on
+        :return: the new state mask
+        """
+        with self.lock:
+            mask &= self.all_mask
+            self.state_mask = mask
+            for node in self.nodes:
+                node.send_state(mask)
+            self.last_write_ns = monotonic_ns()
+            return mask
+
+    def get_mask(self):
+        return self.state_mask
+
+    def set_states(self, states):
+        mask = 0
+        for i, state in enumerate(states):
+            if state:
+                mask |= 1 << i
+        return self.set_mask(mask)
+
+    def set_channel_state(self, channel_num, state):
+        """
+        Turns one global channel on or off
+        :param channel_num: 1-based, from 1 to self.num_channels
+        :param state: 0 - off, 1 - on
+        :return: channel number or False
+        """
+        if not 0 < channel_num <= self.num_channels:
+            return False
+        with self.lock:
+            bit = 1 << (channel_num - 1)
+            self.set_mask(self.state_mask | bit if state else self.state_mask & ~bit)
+        return channel_num
+
+    def kill(self):
+        """
+        Turns every channel off on every node, connected or not as soon as it reconnects
+        :return: nil
+        """
+        with self.lock:
+            self.state_mask = 0
+            for node in self.nodes:
+                if node.send(encode_kill_all()):
+                    node.sent_mask = 0
+
+    def pulse(self, mask, duration, count=1, gap=0.0):
+        """
+        Pulses channels, each node timing its own part of the pulse
+        :param mask: global channels to pulse
+        :param duration: seconds each pulse stays open
+        :param count: number of pulses
+        :param gap: seconds closed between pulses
+        :return: True
+        """
+        with self.lock:
+            for node in self.nodes:
+                local = (mask & node.mask) >> node.first_channel
+                if local:
+                    node.send(encode_pulse_mask(local, duration, count, gap))
+        return True
+
+    def blow(self):
+        self.set_mask(self.all_mask)
+
+    def set_max_on_time(self, new_max_time):
+        with self.lock:
+            self.max_on_time = float(new_max_time)
+            self.max_on_time_set = True
+            for node in self.nodes:
+                node.send(encode_set_max_on_time(new_max_time))
+        return new_max_time
+
+    def assert_max_on_time(self):
+        """ Each node enforces max on time itself """
+        pass
+
+    def start_show_at(self, delay=2.0, timeout=1.0, failed=None):
+        """
+        Starts the show loaded on every node at the same moment, delay seconds from now on the first node's
+        clock. Nodes should follow the first node's cluster clock (puff -F). This only asks the first node for
+        its clock; maintain() sends the start when the answer comes, so the caller does not wait for it.
+        :param delay: seconds from now, long enough for every node to receive the command
+        :param timeout: seconds to wait for the first node's clock
+        :param failed: called without arguments from maintain() if the first node does not answer in time
+        :return: False if the first node is not connected
+        """
+        leader = self.nodes[0]
+        with self.lock:
+            leader.last_clock = None
+            asked = monotonic_ns()
+            if not leader.send(encode(OP_CLOCK_QUERY)):
+                return False
+            self.pending_start = (asked, delay, monotonic() + timeout, failed)
+        return True
+
+    def _start_pending(self):
+        """ Sends the start asked for by start_show_at() now that the first node's clock has answered """
+        with self.lock:
+            pending, self.pending_start = self.pending_start, None
+            clock = self.nodes[0].last_clock
+            if pending is None or clock is None:
+                return
+            # the reply is on average half a round trip old
+            start = clock[0] + (monotonic_ns() - pending[0]) // 2 + int(pending[1] * 1e9)
+            for node in self.nodes:
+                node.send(encode(OP_SHOW_START_AT, start))
+
+    def _start_failed(self):
+        with self.lock:
+            pending, self.pending_start = self.pending_start, None
+        if pending is None:
+            return
+        PuffLog.warning('cluster_start_failed', addr=self.nodes[0].addr)
+        if pending[3] is not None:
+            pending[3]()
+
+    def send_all(self, frame):
+        """
+        Sends the same frame to every node
+        :param frame: frame bytes
+        :return: nil
+        """
+        with self.lock:
+            for node in self.nodes:
+                node.send(frame)
+
+
+class ClusterPlayer(object):
+    """
+    Stands in for a ShowPlayer when a PuffServer serves a cluster: shows are played by the nodes, this only
+    forwards the commands and keeps track of the position for OP_SHOW_QUERY
+    """
+    def __init__(self, cluster, delay=2.0):
+        """
+        :param cluster: PuffCluster to drive
+        :param delay: seconds from a start command to the start, long enough for every node to receive it
+        :return: nil
+        """
+        self.cluster = cluster
+        self.delay = delay
+        self.show = None
+        self.state = STOPPED
+        self.position = 0.0  # show time in seconds while stopped or paused
+        self.origin = 0.0  # monotonic time of show time zero while playing
+
+    def load(self, show):
+        """
+        Uploads each node's part of a show to it, stopping any show playing
+        :param show: Show, in global channels
+        :return: nil
+        """
+        cluster = self.cluster
+        with cluster.lock:
+            for node in cluster.nodes:
+                part = Show()
+                for i in range(len(show)):
+                    part.add_cue(show.time_at(i), (show.mask_at(i) & node.mask) >> node.first_channel)
+                node.send_bulk(encode_show(part))
+        self.show = show
+        self.state = STOPPED
+        self.position = 0.0
+
+    def start(self, at=None):
+        """
+        Starts every node's show together from the current position
+        :param at: monotonic time on this controller to start at, None for delay seconds from now; never sooner
+        than delay seconds from now
+        :return: False if no show is loaded or the first node is not connected; if the first node then does not
+        answer, the player goes back to where it was
+        """
+        if self.show is None:
+            return False
+        if self.state == PLAYING:
+            return True
+        delay = self.delay if at is None else max(self.delay, at - monotonic())
+        state, position = self.state, self.position
+        if not self.cluster.start_show_at(delay, failed=lambda: self._start_failed(state, position)):
+            return False
+        self.origin = monotonic() + delay - self.position
+        self.state = PLAYING
+        return True
+
+    def _start_failed(self, state, position):
+        if self.state == PLAYING:
+            self.state = state
+            self.position = position
+
+    def pause(self):
+        if self.state == PLAYING:
+            self.position = self.current_position()
+            self.state = PAUSED
+            self.cluster.send_all(encode(OP_SHOW_PAUSE))
+
+    def stop(self):
+        self.state = STOPPED
+        self.position = 0.0
+        self.cluster.send_all(encode(OP_SHOW_STOP))
+
+    def seek(self, position):
+        self.position = max(0.0, position)
+        if self.state == PLAYING:
+            self.origin = monotonic() - self.position
+        self.cluster.send_all(encode(OP_SHOW_SEEK, int(round(self.position * 1000))))
+
+    def current_position(self):
+        if self.state == PLAYING:
+            return max(0.0, monotonic() - self.origin)
+        return self.position
+
+
+def parse_nodes(spec):
+    """
+    :param spec: comma separated host:port:channels
+    :return: list of (host, port, num_channels)
+    :raise ValueError: if an item is malformed or a node has more channels than one frame carries
+    """
+    nodes = []
+    for item in spec.split(','):
+        host, port, channels = item.rsplit(':', 2)
+        if not 0 < int(channels) <= MAX_NODE_CHANNELS:
+            raise ValueError('{0}: nodes have 1 to {1} channels'.format(item, MAX_NODE_CHANNELS))
+        nodes.append((host, int(port), int(channels)))
+    return nodes
+
+
+def main(argv):
+    """
+    Serves a cluster of Puff nodes as one bank
+    :return: 0
+    """
+    host = ''
+    port = 4444
+    nodes = None
+    delay = 2.0  # seconds from a show start command to the synchronized start
+
+    try:
+        opts, args = getopt.getopt(argv, 'a:p:n:d:')
+    except getopt.GetoptError:
+        print('Usage PuffCluster -a 192.168.1.100 -p 4444 -n 192.168.1.144:4444:18,192.168.1.145:4444:18 [-d 2]')
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-a':
+            host = arg
+        elif opt == '-p':
+            port = int(arg)
+        elif opt == '-n':
+            try:
+                nodes = parse_nodes(arg)
+            except ValueError as e:
+                print('Bad node list: {0}'.format(e))
+                sys.exit(2)
+        elif opt == '-d':
+            delay = float(arg)
+    if not nodes:
+        print('At least one node is needed, e.g. -n 192.168.1.144:4444:18')
+        sys.exit(2)
+
+    PuffLog.start()
+    cluster = PuffCluster(nodes)
+    print('Serving {0} channels on {1} nodes'.format(cluster.num_channels, len(cluster.nodes)))
+    server = PuffServer(cluster, (host, port), player=ClusterPlayer(cluster, delay))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        server.close()
+    cluster.kill()
+    cluster.close()
+    PuffLog.close()
+    return 0
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
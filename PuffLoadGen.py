@@ -0,0 +1,223 @@
+"""
+Network load generator and latency harness for the Puff server.
+Opens one or more connections and sends cues at a fixed total rate. Every cue toggles the connection's own
+channel and is followed by a query, so the OP_STATE reply gives the round trip time. With -l a Puff server is
+started in this process on the simulated GPIO backend, and the recorded pin transitions also give the
+command to pin latency.
+
+Usage: python PuffLoadGen.py [-a 192.168.1.144] [-p 4444] [-n 2] [-r 500] [-d 10] [-l] [-o results.json]
+"""
+import getopt
+import json
+import socket
+import sys
+import threading
+from array import array
+from collections import deque
+from time import monotonic, monotonic_ns, sleep
+
+from PuffBenchmark import percentile
+from PuffProtocol import CommandParser, OP_STATE, encode_set_channel, encode_query
+
+__author__ = 'Stu D\'Alessandro'
+
+
+class LoadConnection(object):
+    """ One client connection that toggles one channel and times the replies """
+    def __init__(self, addr, channel_num):
+        """
+        :param addr: (host, port) of the Puff server
+        :param channel_num: 1-based channel this connection toggles
+        :return: nil
+        """
+        self.channel_num = channel_num
+        self.state = 0
+        self.sent = array('q')  # monotonic_ns send time of every cue
+        self.rtt = array('q')  # round trip of every answered cue in ns
+        self.pending = deque()
+        self.parser = CommandParser(self.handle)
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def handle(self, opcode, args):
+        if opcode == OP_STATE and self.pending:
+            self.rtt.append(monotonic_ns() - self.pending.popleft())
+
+    def read(self):
+        while True:
+            try:
+                if self.parser.receive(self.sock) == 0:
+                    return
+                self.parser.drain()
+            except OSError:
+                return
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def send_cue(self):
+        """
+        Toggles this connection's channel and asks for the state
+        :return: nil
+        """
+        self.state ^= 1
+        now = monotonic_ns()
+        self.pending.append(now)
+        self.sent.append(now)
+        self.sock.sendall(encode_set_channel(self.channel_num, self.state) + encode_query())
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.reader.join(1.0)
+
+
+def summarize(samples_ns):
+    """
+    :param samples_ns: latency samples in nanoseconds
+    :return: dict with count, p50, p99 and max in milliseconds
+    """
+    ordered = sorted(samples_ns)
+    return {
+        'count': len(ordered),
+        'p50_ms': percentile(ordered, 0.50) / 1e6,
+        'p99_ms': percentile(ordered, 0.99) / 1e6,
+        'max_ms': ordered[-1] / 1e6 if ordered else 0.0,
+    }
+
+
+def pin_latencies(backend, bank, connections):
+    """
+    Matches every cue with the pin transition it caused in the simulated backend
+    :param backend: SimulatedGPIOBackend of the server's bank
+    :param bank: the server's GPIOFireBank
+    :param connections: LoadConnection list
+    :return: array of command to pin latencies in ns
+    """
+    edges = {}
+    for t, pin, value in backend.transitions():
+        edges.setdefault(pin, []).append(t)
+    latencies = array('q')
+    for conn in connections:
+        pin_times = edges.get(bank.pins[conn.channel_num - 1], [])
+        for sent, changed in zip(conn.sent, pin_times):
+            latencies.append(changed - sent)
+    return latencies
+
+
+def run(addr, num_connections, rate, duration):
+    """
+    Sends cues at rate per second, spread round robin over the connections, for duration seconds
+    :return: (connections, seconds actually taken)
+    """
+    connections = [LoadConnection(addr, i + 1) for i in range(num_connections)]
+
+    interval = 1.0 / rate
+    total = int(rate * duration)
+    start = monotonic()
+    for i in range(total):
+        due = start + i * interval
+        delay = due - monotonic()
+        if delay > 0:
+            sleep(delay)
+        connections[i % num_connections].send_cue()
+
+    # give the last replies time to arrive
+    deadline = monotonic() + 2.0
+    while monotonic() < deadline and any(c.pending for c in connections):
+        sleep(0.01)
+    elapsed = monotonic() - start
+    for conn in connections:
+        conn.close()
+    return connections, elapsed
+
+
+def main(argv):
+    """
+    Runs the load generator and prints the latency report
+    :return: 0
+    """
+    host = '127.0.0.1'
+    port = 4444
+    num_connections = 1
+    rate = 500.0
+    duration = 10.0
+    local = False
+    output = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'a:p:n:r:d:lo:')
+    except getopt.GetoptError:
+        print('Usage PuffLoadGen -a 192.168.1.144 -p 4444 -n 2 -r 500 -d 10 [-l] [-o results.json]')
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-a':
+            host = arg
+        elif opt == '-p':
+            port = int(arg)
+        elif opt == '-n':
+            num_connections = int(arg)
+        elif opt == '-r':
+            rate = float(arg)
+        elif opt == '-d':
+            duration = float(arg)
+        elif opt == '-l':
+            local = True
+        elif opt == '-o':
+            output = arg
+
+    server = None
+    if local:
+        from GPIOBackend import SimulatedGPIOBackend
+        from GPIOFireBank import GPIOFireBank
+        from PuffOutput import CommandQueue
+        from PuffServer import PuffServer
+        backend = SimulatedGPIOBackend()
+        bank = GPIOFireBank(max(num_connections, 18), backend=backend)
+        # keep the watchdog out of the measurement; a real node keeps its own max on time
+        bank.set_max_on_time(duration + 60)
+        server = PuffServer(bank, ('127.0.0.1', 0), queue=CommandQueue())
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        host, port = server.addr
+        print('Started local Puff server on port {0} with the simulated backend'.format(port))
+
+    print('Sending {0} cues/sec for {1} s over {2} connection(s) to {3}:{4}'.format(
+        rate, duration, num_connections, host, port))
+    connections, elapsed = run((host, port), num_connections, rate, duration)
+
+    sent = sum(len(c.sent) for c in connections)
+    report = {
+        'rate_requested': rate,
+        'connections': num_connections,
+        'cues_sent': sent,
+        'throughput': sent / elapsed if elapsed else 0.0,
+        'round_trip': summarize([t for c in connections for t in c.rtt]),
+    }
+    if server is not None:
+        server.stop()
+        server_thread.join()
+        report['command_to_pin'] = summarize(pin_latencies(backend, bank, connections))
+
+    print('Sent {cues_sent} cues, {throughput:.1f} cues/sec'.format(**report))
+    for key in ('round_trip', 'command_to_pin'):
+        if key in report:
+            r = report[key]
+            print('{0:<16} n={1:<8} p50 {2:8.3f} ms  p99 {3:8.3f} ms  max {4:8.3f} ms'.format(
+                key, r['count'], r['p50_ms'], r['p99_ms'], r['max_ms']))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results saved to {0}'.format(output))
+    return 0
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,221 @@
+"""
+Non-blocking structured event log for Puff.
+Code on the command path calls info()/warning()/... with an event name and key=value fields. That only
+appends a tuple to a bounded in-memory ring (a deque, whose append is atomic); nothing is formatted and no
+I/O happens on the caller's thread. A background writer drains the ring a few times a second, applies a
+per-level rate limit, formats each record as one line and writes it to stdout or to a size-rotated file.
+If the ring fills up faster than it is drained the oldest records are lost and the loss is logged.
+
+Usage:
+    import PuffLog
+    PuffLog.start('/var/log/puff.log')
+    PuffLog.info('client_connected', addr=addr)
+"""
+import os
+import sys
+import threading
+from collections import deque
+from time import monotonic, time, strftime, localtime
+
+__author__ = 'Stu D\'Alessandro'
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+RATE_LIMITS = {DEBUG: 50, INFO: 100, WARNING: 100, ERROR: None}  # records per second, None for no limit
+
+
+class PuffLog(object):
+    """ A ring of pending records and the thread that writes them out """
+    def __init__(self, capacity=4096, level=INFO, rate_limits=None):
+        """
+        :param capacity: records held before the oldest are dropped
+        :param level: records below this level are ignored
+        :param rate_limits: {level: records per second or None}, RATE_LIMITS if None
+        :return: nil
+        """
+        self.ring = deque(maxlen=capacity)
+        self.level = level
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)
+        self.appended = 0  # approximate, only used to report records lost to a full ring
+        self.written = 0
+        self.suppressed = dict((level, 0) for level in LEVEL_NAMES)
+        self.tokens = {}  # level -> [tokens, monotonic time of last refill]
+        self.path = None
+        self.out = None
+        self.max_bytes = 0
+        self.backups = 0
+        self.interval = 0.2
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def log(self, level, event, **fields):
+        """
+        Appends a record; safe to call from any thread and never blocks
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :param event: short snake_case name of what happened
+        :param fields: values that describe it
+        :return: nil
+        """
+        if level >= self.level:
+            self.ring.append((time(), level, event, fields))
+            self.appended += 1
+
+    def start(self, path=None, max_bytes=1 << 20, backups=3, interval=0.2):
+        """
+        Starts the writer thread
+        :param path: log file, None for stdout
+        :param max_bytes: size at which the file is rotated, 0 to never rotate
+        :param backups: rotated files kept as path.1 to path.N
+        :param interval: seconds between drains of the ring
+        :return: nil
+        """
+        if self.thread is not None:
+            return
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+        self.out = open(path, 'a') if path is not None else sys.stdout
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """
+        Writes whatever is left in the ring and stops the writer thread
+        :return: nil
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if self.path is not None:
+            self.out.close()
+        self.out = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        """
+        Writes out every record in the ring
+        :return: number of records written
+        """
+        ring = self.ring
+        lines = []
+        taken = 0
+        while True:
+            try:
+                record = ring.popleft()
+            except IndexError:
+                break
+            taken += 1
+            if self.allow(record[1]):
+                lines.append(self.format(*record))
+
+        lost = self.appended - self.written - taken - len(ring)
+        if lost > 0:
+            lines.append(self.format(time(), WARNING, 'log_overflow', {'lost': lost}))
+        self.written += taken + max(lost, 0)
+        for level, count in self.suppressed.items():
+            if count and self.allow(level):
+                lines.append(self.format(time(), level, 'log_rate_limited', {'suppressed': count}))
+                self.suppressed[level] = 0
+        if lines:
+            self.write(''.join(lines))
+        return taken
+
+    def allow(self, level):
+        """
+        Token bucket rate limit per level
+        :param level: level of a record
+        :return: True if the record may be written
+        """
+        limit = self.rate_limits.get(level)
+        if limit is None:
+            return True
+        now = monotonic()
+        bucket = self.tokens.get(level)
+        if bucket is None:
+            bucket = self.tokens[level] = [float(limit), now]
+        bucket[0] = min(float(limit), bucket[0] + (now - bucket[1]) * limit)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return True
+        self.suppressed[level] = self.suppressed.get(level, 0) + 1
+        return False
+
+    @staticmethod
+    def format(timestamp, level, event, fields):
+        """
+        :return: one log line, e.g. 2016-05-01 21:04:11.042 INFO client_connected addr=('10.0.0.5', 51000)
+        """
+        stamp = strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp)) + '.{0:03d}'.format(
+            int(timestamp % 1 * 1000))
+        parts = [stamp, LEVEL_NAMES.get(level, str(level)), event]
+        for key in sorted(fields):
+            parts.append('{0}={1}'.format(key, fields[key]))
+        return ' '.join(parts) + '\n'
+
+    def write(self, text):
+        out = self.out if self.out is not None else sys.stdout
+        try:
+            out.write(text)
+            out.flush()
+            if self.path is not None and self.max_bytes and out.tell() >= self.max_bytes:
+                self.rotate()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def rotate(self):
+        """
+        Moves path to path.1, path.1 to path.2 and so on, dropping the oldest, and reopens path
+        :return: nil
+        """
+        self.out.close()
+        for n in range(self.backups - 1, 0, -1):
+            older = '{0}.{1}'.format(self.path, n)
+            if os.path.exists(older):
+                os.replace(older, '{0}.{1}'.format(self.path, n + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.out = open(self.path, 'a')
+
+
+# the process-wide log
+log = PuffLog()
+
+
+def start(path=None, max_bytes=1 << 20, backups=3, interval=0.2):
+    log.start(path, max_bytes, backups, interval)
+
+
+def close():
+    log.close()
+
+
+def debug(event, **fields):
+    log.log(DEBUG, event, **fields)
+
+
+def info(event, **fields):
+    log.log(INFO, event, **fields)
+
+
+def warning(event, **fields):
+    log.log(WARNING, event, **fields)
+
+
+def error(event, **fields):
+    log.log(ERROR, event, **fields)
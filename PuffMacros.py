@@ -0,0 +1,237 @@
+"""
+Named macros: short timed patterns stored on the node and fired by one command.
+
+A macro is a list of steps in time order. A step either sets the macro's channels (the channels used by any of
+its steps) to a mask, leaving every other channel alone, or pulses the channels in its mask for a given time.
+Masks are written for logical channels: bit 0 is the macro's first channel. When a macro is run it can be
+sped up or slowed down, mapped onto any subset of the bank (logical channel n becomes the n-th channel of the
+subset) and repeated. Steps are timed by the bank's watchdog, like pulses, so the pattern keeps its timing
+whatever the network does, max on time still applies and kill() cancels every running macro.
+
+Macro files are plain text, times and pulse lengths in milliseconds, masks in any Python integer notation:
+    # a four channel chase
+    [chase]
+    0    0b0001
+    100  0b0010
+    200  0b0100
+    300  0b1000
+    400  0
+    end 400         # period for repeats, at least the time of the last step, which it is if omitted
+
+    [burst]
+    0    0b1111 50  # pulse every channel for 50 ms
+"""
+from array import array
+from time import monotonic
+
+__author__ = 'Stu D\'Alessandro'
+
+MAX_NAME = 8  # bytes, names are sent over the protocol in a fixed field
+MAX_MASK = (1 << 64) - 1  # step masks are kept in an array('Q') and sent as one 64 bit word
+
+
+class Macro(object):
+    """ Steps kept in parallel arrays: times in seconds, logical masks, pulse lengths (0 for a state step) """
+    def __init__(self, name):
+        self.name = name
+        self.times = array('d')
+        self.masks = array('Q')
+        self.pulses = array('d')
+        self.period = None  # seconds between repeats, None for the time of the last step
+        self.scope = 0  # every logical channel the macro uses
+
+    def add_step(self, time, mask, pulse=0.0):
+        """
+        Appends a step. Steps must be added in time order.
+        :param time: seconds from the start of the macro
+        :param mask: logical channels to turn on, or to pulse if pulse is set
+        :param pulse: seconds to pulse the channels in mask, 0 to set the macro's channels to mask
+        :return: True if the step was added, False if it is earlier than the last step or after the period
+        :raise ValueError: if the mask does not fit in 64 bits
+        """
+        if not 0 <= mask <= MAX_MASK:
+            raise ValueError('step masks are 64 bit, {0:#x} is not'.format(mask))
+        if (self.times and time < self.times[-1]) or (self.period is not None and time > self.period):
+            return False
+        self.times.append(time)
+        self.masks.append(mask)
+        self.pulses.append(pulse)
+        self.scope |= mask
+        return True
+
+    def set_period(self, period):
+        """
+        Sets the time between repeats
+        :param period: seconds, at least the time of the last step so one repeat does not overlap the next
+        :return: False if the period is shorter than the steps
+        """
+        if self.times and period < self.times[-1]:
+            return False
+        self.period = period
+        return True
+
+    def __len__(self):
+        return len(self.times)
+
+    def duration(self):
+        """
+        :return: seconds from one repeat to the next
+        """
+        if self.period is not None:
+            return self.period
+        return self.times[-1] if self.times else 0.0
+
+
+def spread(mask, channels):
+    """
+    Maps logical channels onto a subset of the bank
+    :param mask: logical mask, bit n is the subset's n-th channel
+    :param channels: subset of the bank as a mask, 0 for the whole bank in order
+    :return: bank mask
+    """
+    if channels == 0:
+        return mask
+    result = 0
+    while mask and channels:
+        low = channels & -channels
+        channels ^= low
+        if mask & 1:
+            result |= low
+        mask >>= 1
+    return result
+
+
+def load_macros(path):
+    """
+    Reads a macro file
+    :param path: file to read, see the module docstring for the format
+    :return: dict of name to Macro
+    :raise ValueError: if the file is malformed
+    """
+    macros = {}
+    macro = None
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                if line.startswith('[') and line.endswith(']'):
+                    name = line[1:-1].strip()
+                    if not name or len(name.encode('ascii')) > MAX_NAME:
+                        raise ValueError('macro names are 1 to {0} ASCII characters'.format(MAX_NAME))
+                    macro = macros[name] = Macro(name)
+                    continue
+                if macro is None:
+                    raise ValueError('step before the first [name]')
+                fields = line.split()
+                if fields[0] == 'end' and len(fields) == 2:
+                    if not macro.set_period(int(fields[1], 0) / 1000.0):
+                        raise ValueError('end is earlier than the last step')
+                elif len(fields) in (2, 3):
+                    pulse = int(fields[2], 0) / 1000.0 if len(fields) == 3 else 0.0
+                    if not macro.add_step(int(fields[0], 0) / 1000.0, int(fields[1], 0), pulse):
+                        raise ValueError('step is earlier than the one before it or later than end')
+                else:
+                    raise ValueError('expected "time mask [pulse]" or "end time"')
+            except (ValueError, UnicodeEncodeError) as e:
+                raise ValueError('{0} line {1}: {2}'.format(path, number, e))
+    return macros
+
+
+class MacroPlayer(object):
+    """ Holds a bank's macros and runs them on the bank's watchdog """
+    def __init__(self, bank):
+        """
+        :param bank: the GPIOFireBank to drive
+        :return: nil
+        """
+        self.bank = bank
+        self.macros = {}
+        self.stopped = {}  # name -> stop count, a running macro ends when it changes
+
+    def define(self, macro):
+        """
+        Adds or replaces a macro
+        :param macro: Macro
+        :return: nil
+        """
+        self.macros[macro.name] = macro
+
+    def run(self, name, speed=1.0, channels=0, repeat=1):
+        """
+        Starts a macro now
+        :param name: macro name
+        :param speed: 2.0 plays twice as fast
+        :param channels: bank mask the macro's logical channels are mapped onto, 0 for the whole bank
+        :param repeat: times to play the macro, 0 to repeat until stopped or killed
+        :return: False if there is no such macro or no watchdog to time it
+        """
+        macro = self.macros.get(name)
+        watchdog = self.bank.watchdog
+        if macro is None or len(macro) == 0 or watchdog is None or speed <= 0:
+            return False
+        bank = self.bank
+        # map and scale once, every step then costs one bank call
+        masks = array('Q', (spread(mask, channels) & bank.all_mask for mask in macro.masks))
+        times = array('d', (t / speed for t in macro.times))
+        pulses = array('d', (p / speed for p in macro.pulses))
+        scope = spread(macro.scope, channels) & bank.all_mask
+        period = macro.duration() / speed
+        if repeat == 0 and period <= 0:
+            return False
+        with bank.lock:
+            run = (name, times, masks, pulses, scope, period, repeat, monotonic(),
+                   bank.pulse_generation, self.stopped.get(name, 0))
+            self._step(run, 0, 0)
+        return True
+
+    def stop(self, name=None):
+        """
+        Stops a running macro, leaving its channels as they are
+        :param name: macro to stop, None for all
+        :return: nil
+        """
+        # unknown names are ignored, so clients cannot grow stopped without limit
+        for key in ([name] if name is not None else list(self.macros)):
+            if key in self.macros:
+                self.stopped[key] = self.stopped.get(key, 0) + 1
+
+    def _step(self, run, index, iteration):
+        """
+        Applies one step and schedules the next. Step times are computed from the start of the run so they
+        do not drift. Steps missed by a late wakeup are skipped rather than replayed in a burst: the macro's
+        channels are set once, to the latest due state, and a pulse is only fired if it is the latest due step.
+        """
+        name, times, masks, pulses, scope, period, repeat, start, generation, stop_count = run
+        bank = self.bank
+        watchdog = bank.watchdog
+        with bank.lock:
+            if generation != bank.pulse_generation or stop_count != self.stopped.get(name, 0) or watchdog is None:
+                return
+            now = monotonic()
+            state = None  # mask of the latest due state step
+            pulse = None  # the latest due step if it is a pulse
+            due = None  # time of the next step, None once the run is over
+            while True:
+                if pulses[index] > 0:
+                    pulse = index
+                else:
+                    state = masks[index]
+                    pulse = None
+                index += 1
+                if index == len(times):
+                    index = 0
+                    iteration += 1
+                    if repeat and iteration >= repeat:
+                        break
+                due = start + iteration * period + times[index]
+                if due > now:
+                    break
+                due = None
+            if state is not None:
+                bank.set_mask((bank.state_mask & ~scope) | state)
+            if pulse is not None:
+                bank.pulse(masks[pulse], pulses[pulse])
+            if due is not None:
+                watchdog.call_at(due, self._step, run, index, iteration)
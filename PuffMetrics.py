@@ -0,0 +1,223 @@
+"""
+Command latency instrumentation for Puff.
+Every command is timestamped when its bytes are received, when its frame is parsed, when it is dispatched to
+the bank and when the bank writes the GPIO pins. The gaps are kept in fixed-size log-linear (HDR style)
+histograms, alongside counters for commands, bytes and watchdog forced-offs. Recording is a few integer
+operations and never allocates; the histograms are rolled into a completed window at a fixed interval.
+"""
+import threading
+from array import array
+from time import monotonic, monotonic_ns
+
+import PuffLog
+
+__author__ = 'Stu D\'Alessandro'
+
+STAGES = ('parse', 'dispatch', 'write', 'total')  # receive to parse, parse to dispatch, dispatch to write, all
+
+
+class LatencyHistogram(object):
+    """
+    Counts values in buckets that are linear within each power of two, so the resolution is about 1 part in
+    2 ** SUB_BITS at every scale and the size is fixed
+    """
+    SUB_BITS = 4
+
+    def __init__(self, max_value=60 * 10 ** 9):
+        """
+        :param max_value: largest value tracked separately (ns), larger values count in the last bucket
+        :return: nil
+        """
+        self.sub_buckets = 1 << self.SUB_BITS
+        size = self.sub_buckets * (max_value.bit_length() - self.SUB_BITS + 1)
+        self.counts = array('Q', bytes(8 * size))
+        self.last = size - 1
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def bucket(self, value):
+        """
+        :param value: non-negative integer
+        :return: bucket index of value
+        """
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.SUB_BITS - 1
+        index = (shift + 1) * self.sub_buckets + (value >> shift) - self.sub_buckets
+        return index if index < self.last else self.last
+
+    def bucket_value(self, index):
+        """
+        :param index: bucket index
+        :return: the midpoint of the values counted in that bucket
+        """
+        if index < self.sub_buckets:
+            return index
+        shift = index // self.sub_buckets - 1
+        low = (self.sub_buckets + index % self.sub_buckets) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self.counts[self.bucket(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :param fraction: 0.0 to 1.0
+        :return: approximate value below which that fraction of the recorded values fall, 0 if empty
+        """
+        if self.total == 0:
+            return 0
+        wanted = max(1, int(round(fraction * self.total)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def count_below(self, value):
+        """
+        :param value: upper bound
+        :return: number of recorded values in the buckets up to the one holding value
+        """
+        last = self.bucket(value)
+        return sum(self.counts[i] for i in range(last + 1))
+
+    def merge(self, other):
+        """
+        Adds the values recorded by another histogram of the same size
+        :param other: LatencyHistogram
+        :return: nil
+        """
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+
+class PuffMetrics(object):
+    """ Latency histograms and counters for one Puff process """
+    def __init__(self, bank=None):
+        """
+        :param bank: GPIOFireBank whose watchdog forced-off count is reported
+        :return: nil
+        """
+        self.bank = bank
+        self.commands = 0
+        self.bytes = 0
+        self.recv_ns = 0  # receive time of the bytes being parsed
+        self.current = dict((stage, LatencyHistogram()) for stage in STAGES)
+        self.window = dict((stage, LatencyHistogram()) for stage in STAGES)  # last completed window
+        self.lifetime = dict((stage, LatencyHistogram()) for stage in STAGES)  # completed windows so far
+        self.lock = threading.Lock()  # between roll() and readers of lifetime, never taken when recording
+        self.window_start = monotonic()
+        self.window_commands = 0
+        self.window_bytes = 0
+        self.rates = (0.0, 0.0)  # commands/sec and bytes/sec over the last completed window
+
+    def received(self, nbytes):
+        """
+        Called by the network layer for every read
+        :param nbytes: bytes received
+        :return: nil
+        """
+        self.recv_ns = monotonic_ns()
+        self.bytes += nbytes
+
+    def command(self, recv_ns, parsed_ns, dispatched_ns, written_ns):
+        """
+        Records the timeline of one command
+        :param recv_ns: when the bytes holding the frame were received
+        :param parsed_ns: when the frame was decoded
+        :param dispatched_ns: when it was handed to the bank
+        :param written_ns: when the bank last wrote its pins, earlier than dispatched_ns if this command did
+        not write them
+        :return: nil
+        """
+        self.commands += 1
+        current = self.current
+        if recv_ns > parsed_ns:
+            recv_ns = parsed_ns
+        current['parse'].record(parsed_ns - recv_ns)
+        current['dispatch'].record(dispatched_ns - parsed_ns)
+        if written_ns >= dispatched_ns:
+            current['write'].record(written_ns - dispatched_ns)
+            current['total'].record(written_ns - recv_ns)
+
+    def forced_offs(self):
+        return self.bank.forced_offs if self.bank is not None else 0
+
+    def roll(self):
+        """
+        Completes the current window: its histograms become the reported ones and rates are updated
+        :return: nil
+        """
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.window_start
+            if elapsed > 0:
+                self.rates = ((self.commands - self.window_commands) / elapsed,
+                              (self.bytes - self.window_bytes) / elapsed)
+            self.window_start = now
+            self.window_commands = self.commands
+            self.window_bytes = self.bytes
+            # the two sets of histograms swap places, so rolling never allocates either
+            for histogram in self.window.values():
+                histogram.reset()
+            self.current, self.window = self.window, self.current
+            for stage, histogram in self.window.items():
+                self.lifetime[stage].merge(histogram)
+
+    def cumulative(self, stage):
+        """
+        :param stage: one of STAGES
+        :return: LatencyHistogram of every value recorded for stage so far
+        """
+        histogram = LatencyHistogram()
+        with self.lock:
+            histogram.merge(self.lifetime[stage])
+            histogram.merge(self.current[stage])
+        return histogram
+
+    def summary(self):
+        """
+        :return: dict describing the last completed window, latencies are receive to GPIO write in us
+        """
+        total = self.window['total']
+        return {'cmd_per_sec': round(self.rates[0]), 'bytes_per_sec': round(self.rates[1]),
+                'commands': self.commands, 'forced_offs': self.forced_offs(),
+                'p50_us': round(total.percentile(0.5) / 1000.0, 1), 'p99_us': round(total.percentile(0.99) / 1000.0, 1),
+                'p999_us': round(total.percentile(0.999) / 1000.0, 1), 'max_us': round(total.max / 1000.0, 1)}
+
+    def report_every(self, interval):
+        """
+        Starts a thread that rolls the window and logs a summary every interval seconds
+        :param interval: seconds
+        :return: the thread
+        """
+        def report():
+            stopped = threading.Event()
+            while not stopped.wait(interval):
+                self.roll()
+                PuffLog.info('metrics', **self.summary())
+        thread = threading.Thread(target=report)
+        thread.daemon = True
+        thread.start()
+        return thread
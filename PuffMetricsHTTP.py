@@ -0,0 +1,141 @@
+"""
+Serves Puff's counters and gauges over HTTP in the Prometheus text format, so a monitoring system can scrape
+the node. The listener runs on its own daemon threads and only reads: per channel usage is copied from the
+bank in one short critical section and latency histograms are read from PuffMetrics under its own lock,
+which the command path never takes.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+from PuffMetrics import STAGES
+
+__author__ = 'Stu D\'Alessandro'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+class MetricsHTTPServer(object):
+    """ Answers GET /metrics from a background thread """
+    def __init__(self, metrics, bank, server=None, watchdog=None, addr=('', 9464)):
+        """
+        :param metrics: PuffMetrics of the process
+        :param bank: GPIOFireBank to report channel usage for
+        :param server: PuffServer to report clients and queues for, or None
+        :param watchdog: NaggingMother to report the deadline queue of, or None
+        :param addr: (host, port) to listen on
+        :return: nil
+        """
+        self.metrics = metrics
+        self.bank = bank
+        self.server = server
+        self.watchdog = watchdog
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(addr, Handler)
+        self.httpd.daemon_threads = True
+        self.addr = self.httpd.server_address
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join(1.0)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{0}{1} {2}'.format(name, labels, value))
+
+        bank = self.bank
+        on_times, activations, expirations = bank.usage()
+        channels = ['{{channel="{0}"}}'.format(i + 1) for i in range(bank.num_channels)]
+        metric('puff_channel_on_seconds_total', 'counter', 'Seconds each channel has been on.',
+               [(channels[i], repr(on_times[i])) for i in range(bank.num_channels)])
+        metric('puff_channel_activations_total', 'counter', 'Times each channel was turned on.',
+               [(channels[i], activations[i]) for i in range(bank.num_channels)])
+        metric('puff_channel_forced_off_total', 'counter', 'Times the watchdog forced each channel off.',
+               [(channels[i], expirations[i]) for i in range(bank.num_channels)])
+        metric('puff_channels_on', 'gauge', 'Channels on now.', [('', bin(bank.get_mask()).count('1'))])
+        metric('puff_max_on_time_seconds', 'gauge', 'Max on time of the bank.', [('', repr(bank.max_on_time))])
+        fuel = bank.fuel
+        if fuel is not None:
+            with bank.lock:
+                pressure, used = fuel.estimate(monotonic())
+                flow, refused = fuel.flow, fuel.refused
+            metric('puff_fuel_used_total', 'counter', 'Fuel burned, estimated by the fuel model.', [('', repr(used))])
+            metric('puff_fuel_flow', 'gauge', 'Nominal fuel flow of the open channels per second.',
+                   [('', repr(flow))])
+            metric('puff_accumulator_pressure_psi', 'gauge', 'Accumulator pressure, estimated by the fuel model.',
+                   [('', repr(pressure))])
+            metric('puff_fuel_refused_total', 'counter', 'Channel openings refused by the fuel limits.',
+                   [('', refused)])
+
+        metrics = self.metrics
+        metric('puff_commands_total', 'counter', 'Commands executed.', [('', metrics.commands)])
+        metric('puff_received_bytes_total', 'counter', 'Command bytes received.', [('', metrics.bytes)])
+
+        server = self.server
+        if server is not None:
+            connections = list(server.connections.values())
+            metric('puff_connected_clients', 'gauge', 'Connected TCP clients.', [('', len(connections))])
+            metric('puff_controlling_clients', 'gauge', 'Connected clients that have changed the bank.',
+                   [('', sum(1 for conn in connections if conn.controller))])
+            metric('puff_reply_backlog_bytes', 'gauge', 'Reply bytes waiting for slow clients.',
+                   [('', sum(len(conn.outbox) for conn in connections))])
+            if server.queue is not None:
+                queue = server.queue
+                metric('puff_command_queue_depth', 'gauge', 'Commands waiting for the output thread.',
+                       [('', len(queue))])
+                metric('puff_command_queue_overflow_total', 'counter',
+                       'Commands coalesced, dropped or rejected because the queue was full.',
+                       [('{action="coalesced"}', queue.coalesced), ('{action="dropped"}', queue.dropped),
+                        ('{action="rejected"}', queue.rejected)])
+            if server.datagrams is not None:
+                metric('puff_udp_dropped_total', 'counter', 'Late, duplicate or malformed datagrams dropped.',
+                       [('', server.datagrams.dropped)])
+        if self.watchdog is not None:
+            metric('puff_watchdog_queue_depth', 'gauge', 'Deadlines and timed actions waiting in the watchdog.',
+                   [('', len(self.watchdog.deadlines))])
+
+        lines.append('# HELP puff_command_latency_seconds Command latency by stage, total is receive to GPIO write.')
+        lines.append('# TYPE puff_command_latency_seconds histogram')
+        for stage in STAGES:
+            histogram = metrics.cumulative(stage)
+            # the copied counts can be a few commands ahead of or behind the copied total, since the command
+            # path records while they are read; +Inf and count come from the same counts as the other buckets
+            total = sum(histogram.counts)
+            for bound in LATENCY_BUCKETS:
+                lines.append('puff_command_latency_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(
+                    stage, bound, histogram.count_below(int(bound * 1e9))))
+            lines.append('puff_command_latency_seconds_bucket{{stage="{0}",le="+Inf"}} {1}'.format(stage, total))
+            lines.append('puff_command_latency_seconds_sum{{stage="{0}"}} {1!r}'.format(stage, histogram.sum / 1e9))
+            lines.append('puff_command_latency_seconds_count{{stage="{0}"}} {1}'.format(stage, total))
+        lines.append('')
+        return '\n'.join(lines)
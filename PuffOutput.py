@@ -0,0 +1,192 @@
+"""
+Decouples the network from the GPIO pins.
+Network readers only decode frames and put them on a bounded CommandQueue; one OutputThread takes them off in
+order, executes them against the bank through the CommandProcessor and hands any reply back to the reader
+that queued the command. When the queue is full, or one client has filled its share of it, the queue's policy
+decides what gives:
+    COALESCE     - drop queued channel states that the new full frame (OP_SET_MASK, OP_SET_WIDE_MASK)
+                   overwrites anyway; anything else is rejected
+    DROP_OLDEST  - drop the client's oldest queued command
+    REJECT       - refuse the new command, the client gets ERR_BUSY
+OP_KILL_ALL is never refused or dropped: it is queued past the limit and every channel state, pulse or macro
+run queued before it, which it would undo or cancel anyway, is discarded so it runs next.
+"""
+import threading
+from collections import deque
+from time import monotonic_ns
+
+import RealTime
+from PuffProtocol import OP_SET_CHANNEL, OP_SET_MASK, OP_SET_WIDE_MASK, OP_KILL_ALL, OP_PULSE_CHANNEL, \
+    OP_PULSE_MASK, OP_MACRO_RUN, OP_PATTERN_PLAY
+
+__author__ = 'Stu D\'Alessandro'
+
+COALESCE = 'coalesce'
+DROP_OLDEST = 'drop-oldest'
+REJECT = 'reject'
+POLICIES = (COALESCE, DROP_OLDEST, REJECT)
+
+FRAME_OPS = (OP_SET_MASK, OP_SET_WIDE_MASK)  # set every channel, so overwrite any state queued before them
+STATE_OPS = (OP_SET_CHANNEL, OP_SET_MASK, OP_SET_WIDE_MASK)
+KILLED_OPS = (OP_SET_CHANNEL, OP_SET_MASK, OP_SET_WIDE_MASK, OP_PULSE_CHANNEL, OP_PULSE_MASK, OP_MACRO_RUN,
+              OP_PATTERN_PLAY)
+
+
+class CommandQueue(object):
+    """
+    Bounded FIFO of decoded commands. Each entry is (opcode, args, receive ns, parse ns, source, address);
+    source is the reader that queued it and has a queued attribute counting its entries and a
+    reply(data, address) method.
+    """
+    def __init__(self, capacity=256, policy=COALESCE, source_limit=None):
+        """
+        :param capacity: commands held before the policy applies
+        :param policy: COALESCE, DROP_OLDEST or REJECT
+        :param source_limit: commands one source may have queued, capacity // 2 if None, so a flooding client
+        leaves room for the others
+        :return: nil
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy {0}, expected one of {1}'.format(policy, ', '.join(POLICIES)))
+        self.capacity = capacity
+        self.policy = policy
+        self.source_limit = source_limit if source_limit is not None else max(1, capacity // 2)
+        self.entries = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.coalesced = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, opcode, args, recv_ns, parsed_ns, source, address=None):
+        """
+        Queues a command, applying the policy if the queue or the source's share of it is full
+        :param opcode: command opcode
+        :param args: unpacked payload or None
+        :param recv_ns: when the bytes holding it were received
+        :param parsed_ns: when it was decoded
+        :param source: reader that queued it
+        :param address: passed back to source.reply, e.g. the sender of a datagram
+        :return: False if the command was rejected
+        """
+        entry = (opcode, args, recv_ns, parsed_ns, source, address)
+        with self.cond:
+            if self.closed:
+                return False
+            if opcode == OP_KILL_ALL:
+                self._discard(lambda e: e[0] in KILLED_OPS)
+            elif len(self.entries) >= self.capacity or source.queued >= self.source_limit:
+                if not self._make_room(opcode, source):
+                    self.rejected += 1
+                    return False
+            self.entries.append(entry)
+            source.queued += 1
+            self.cond.notify()
+            return True
+
+    def _make_room(self, opcode, source):
+        """
+        Applies the policy to a full queue
+        :return: True if the new command may be queued
+        """
+        if self.policy == COALESCE:
+            if opcode in FRAME_OPS:
+                self.coalesced += self._discard(lambda e: e[4] is source and e[0] in STATE_OPS)
+        elif self.policy == DROP_OLDEST:
+            for entry in self.entries:
+                if entry[4] is source and entry[0] != OP_KILL_ALL:
+                    self.entries.remove(entry)
+                    source.queued -= 1
+                    self.dropped += 1
+                    break
+        return len(self.entries) < self.capacity and source.queued < self.source_limit
+
+    def _discard(self, match):
+        """
+        Removes the queued entries for which match(entry) is true
+        :return: number of entries removed
+        """
+        kept = deque()
+        removed = 0
+        for entry in self.entries:
+            if match(entry):
+                entry[4].queued -= 1
+                removed += 1
+            else:
+                kept.append(entry)
+        self.entries = kept
+        return removed
+
+    def forget(self, source):
+        """
+        Discards everything a source has queued, e.g. when its client disconnects
+        :return: number of entries removed
+        """
+        with self.cond:
+            return self._discard(lambda e: e[4] is source)
+
+    def get(self):
+        """
+        Waits for the next command
+        :return: entry, or None once the queue is closed
+        """
+        with self.cond:
+            while not self.entries:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            entry = self.entries.popleft()
+            entry[4].queued -= 1
+            return entry
+
+    def close(self):
+        """
+        Wakes the consumer; commands already queued are still handed out
+        :return: nil
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class OutputThread(object):
+    """ The one thread that executes network commands against the bank """
+    def __init__(self, processor, queue):
+        """
+        :param processor: CommandProcessor that executes the commands
+        :param queue: CommandQueue the readers fill
+        :return: nil
+        """
+        self.processor = processor
+        self.queue = queue
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        RealTime.enter('output')
+        processor = self.processor
+        metrics = processor.metrics
+        bank = processor.bank
+        get = self.queue.get
+        while True:
+            entry = get()
+            if entry is None:
+                return
+            opcode, args, recv_ns, parsed_ns, source, address = entry
+            dispatched = monotonic_ns()
+            reply = processor.execute(opcode, args)
+            metrics.command(recv_ns, parsed_ns, dispatched, bank.last_write_ns)
+            if reply is not None:
+                source.reply(reply, address)
+
+    def close(self):
+        """
+        Runs the commands still queued and stops the thread
+        :return: nil
+        """
+        self.queue.close()
+        self.thread.join()
@@ -0,0 +1,353 @@
+"""
+Parametric effects as lazy generators of channel masks, one mask per tick.
+Every effect yields logical masks for num_channels channels (bit 0 is the first channel) forever, or for as
+long as its parameters say, and keeps only a few integers of state, so an ambient effect can run all night in
+constant memory. Effects compose: overlay() combines several with OR, AND or XOR, accelerate() changes the
+speed of another effect over time, and itertools.islice() cuts one to a length. Parameters are checked when an
+effect is created, so a bad one raises ValueError there rather than in the middle of playback.
+
+PatternPlayer pulls one frame per tick from an effect on its own thread and applies it to the bank, timed like
+ShowPlayer's cues, so nothing is rendered ahead of time and effect code never runs on the watchdog thread.
+Effects can be started from the command line (puff -e) and over the network (OP_PATTERN_PLAY) by name, see
+make_effect().
+
+    player = PatternPlayer(bank)
+    player.play(overlay(OR, chase(18, width=2), strobe(0b11, 1, 9)), rate=20)
+"""
+import random
+import threading
+from operator import or_, and_, xor
+from time import monotonic
+
+import PuffLog
+import RealTime
+from PrecisionTimer import SPIN, spin_until
+from PuffMacros import spread
+
+__author__ = 'Stu D\'Alessandro'
+
+OR = or_
+AND = and_
+XOR = xor
+
+# effects that can be started by name, the index is the effect number sent with OP_PATTERN_PLAY
+EFFECTS = ('chase', 'ping_pong', 'wave', 'sparkle', 'strobe')
+# the integer parameters of each default to these when left out, see make_effect()
+EFFECT_DEFAULTS = {'chase': (1, 1), 'ping_pong': (1,), 'wave': (20, 50, 1), 'sparkle': (10, 0), 'strobe': (1, 1)}
+
+
+def chase(num_channels, width=1, step=1):
+    """
+    A block of channels moving along the bank and wrapping around
+    :param num_channels: channels in the effect
+    :param width: channels on at once
+    :param step: channels moved per tick, negative to run backwards
+    """
+    if num_channels < 1 or not 0 <= width <= num_channels:
+        raise ValueError('chase needs at least one channel and a width of 0 to num_channels')
+
+    def frames():
+        all_mask = (1 << num_channels) - 1
+        block = (1 << width) - 1
+        position = 0
+        while True:
+            # rotate the block so it wraps around the end of the bank
+            yield ((block << position) | (block >> (num_channels - position))) & all_mask
+            position = (position + step) % num_channels
+    return frames()
+
+
+def ping_pong(num_channels, width=1):
+    """
+    A block of channels running to the end of the bank and back
+    :param num_channels: channels in the effect
+    :param width: channels on at once
+    """
+    if num_channels < 1 or not 1 <= width <= num_channels:
+        raise ValueError('ping_pong needs at least one channel and a width of 1 to num_channels')
+
+    def frames():
+        block = (1 << width) - 1
+        last = num_channels - width
+        position = 0
+        direction = 1
+        while True:
+            yield block << position
+            if last == 0:
+                continue
+            if not 0 <= position + direction <= last:
+                direction = -direction
+            position += direction
+    return frames()
+
+
+def wave(num_channels, period, duty=0.5, spacing=1):
+    """
+    Every channel blinking with the same period, each a little later than the one before, so bands of flame
+    travel along the bank
+    :param num_channels: channels in the effect
+    :param period: ticks per cycle of one channel
+    :param duty: fraction of each cycle a channel is on
+    :param spacing: ticks between neighbouring channels
+    """
+    if num_channels < 1 or period < 1 or not 0.0 <= duty <= 1.0:
+        raise ValueError('wave needs at least one channel, a period of at least one tick and a duty of 0 to 1')
+
+    def frames():
+        on_ticks = int(round(period * duty))
+        tick = 0
+        while True:
+            mask = 0
+            for i in range(num_channels):
+                if (tick - i * spacing) % period < on_ticks:
+                    mask |= 1 << i
+            yield mask
+            tick = (tick + 1) % period
+    return frames()
+
+
+def sparkle(num_channels, probability=0.1, seed=None):
+    """
+    Random channels, each on in a tick with the given probability
+    :param num_channels: channels in the effect
+    :param probability: chance of each channel being on in a tick
+    :param seed: seed for a repeatable sparkle, None for a different one every time
+    """
+    if num_channels < 1 or not 0.0 <= probability <= 1.0:
+        raise ValueError('sparkle needs at least one channel and a probability of 0 to 1')
+
+    def frames():
+        rng = random.Random(seed)
+        while True:
+            mask = 0
+            for i in range(num_channels):
+                if rng.random() < probability:
+                    mask |= 1 << i
+            yield mask
+    return frames()
+
+
+def strobe(mask, on_ticks=1, off_ticks=1):
+    """
+    The same channels flashing on and off
+    :param mask: channels that flash
+    :param on_ticks: ticks on per flash
+    :param off_ticks: ticks off between flashes
+    """
+    if on_ticks < 0 or off_ticks < 0 or on_ticks + off_ticks < 1:
+        raise ValueError('strobe needs on and off ticks of 0 or more, at least one tick in all')
+
+    def frames():
+        while True:
+            for i in range(on_ticks):
+                yield mask
+            for i in range(off_ticks):
+                yield 0
+    return frames()
+
+
+def accelerate(effect, start_hold, end_hold, ticks):
+    """
+    Plays another effect slowly at first and faster and faster, by holding each of its frames for fewer
+    ticks. Ends when the inner effect does; after ticks, every frame is held for end_hold ticks.
+    :param effect: iterator of masks
+    :param start_hold: ticks each frame is held at the start
+    :param end_hold: ticks each frame is held at the end, smaller than start_hold to speed up
+    :param ticks: ticks over which the hold changes from start_hold to end_hold
+    """
+    if start_hold < 1 or end_hold < 1:
+        raise ValueError('accelerate needs holds of at least one tick')
+
+    def frames():
+        elapsed = 0
+        for mask in effect:
+            progress = min(1.0, elapsed / float(ticks)) if ticks > 0 else 1.0
+            hold = max(1, int(round(start_hold + (end_hold - start_hold) * progress)))
+            for i in range(hold):
+                yield mask
+            elapsed += hold
+    return frames()
+
+
+def overlay(op, *effects):
+    """
+    Combines effects tick by tick, ending when the first of them ends
+    :param op: OR, AND or XOR, or any function of two masks
+    :param effects: iterators of masks
+    """
+    if not effects:
+        raise ValueError('overlay needs at least one effect')
+    iterators = [iter(effect) for effect in effects]
+
+    def frames():
+        while True:
+            try:
+                mask = next(iterators[0])
+                for iterator in iterators[1:]:
+                    mask = op(mask, next(iterator))
+            except StopIteration:
+                return
+            yield mask
+    return frames()
+
+
+def make_effect(name, num_channels, *params):
+    """
+    Builds one of the EFFECTS from integer parameters, as given on the command line or sent over the network
+    :param name: one of EFFECTS
+    :param num_channels: channels in the effect
+    :param params: integer parameters, missing ones take EFFECT_DEFAULTS:
+        chase width, step; ping_pong width; wave period, duty percent, spacing; sparkle probability percent,
+        seed (0 for random); strobe on ticks, off ticks
+    :return: iterator of masks
+    :raise ValueError: if the name is unknown or a parameter is out of range
+    """
+    if name not in EFFECT_DEFAULTS:
+        raise ValueError('Unknown effect {0}, expected one of {1}'.format(name, ', '.join(EFFECTS)))
+    defaults = EFFECT_DEFAULTS[name]
+    params = tuple(params[:len(defaults)]) + defaults[len(params):]
+    if name == 'chase':
+        return chase(num_channels, params[0], params[1])
+    if name == 'ping_pong':
+        return ping_pong(num_channels, params[0])
+    if name == 'wave':
+        return wave(num_channels, params[0], params[1] / 100.0, params[2])
+    if name == 'sparkle':
+        return sparkle(num_channels, params[0] / 100.0, params[1] or None)
+    return strobe((1 << num_channels) - 1, params[0], params[1])
+
+
+def parse_effect(spec, num_channels):
+    """
+    :param spec: name[:param...][@rate], e.g. wave:40:30:2@25
+    :param num_channels: channels in the effect
+    :return: (effect, ticks per second)
+    :raise ValueError: if the spec is malformed
+    """
+    spec, _, rate = spec.partition('@')
+    fields = spec.split(':')
+    return make_effect(fields[0], num_channels, *[int(field) for field in fields[1:]]), \
+        float(rate) if rate else 20.0
+
+
+class PatternPlayer(object):
+    """ Plays one effect at a time on a bank from its own thread, pulling one frame per tick """
+    def __init__(self, bank, spin=SPIN):
+        """
+        :param bank: the GPIOFireBank to drive
+        :param spin: seconds before each tick at which the thread stops sleeping and spins
+        :return: nil
+        """
+        self.bank = bank
+        self.spin = spin
+        self.effect = None  # iterator of logical masks being played, None when idle
+        self.interval = 0.05  # seconds per tick
+        self.channels = 0
+        self.scope = 0
+        self.origin = 0.0  # monotonic time of tick 0
+        self.tick = 0  # next tick to apply
+        self.bank_generation = 0  # bank.pulse_generation when the effect started, kill() ends the effect
+        self.generation = 0  # bumped by every command so a tick being spun on can be abandoned
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, effect, rate=20.0, channels=0, scope=None):
+        """
+        Starts an effect now, replacing any effect playing
+        :param effect: iterator of logical masks
+        :param rate: ticks per second
+        :param channels: bank mask the logical channels are mapped onto, 0 for the whole bank
+        :param scope: bank channels the effect owns and turns off when its mask does not have them, every
+        channel mapped to if None; other channels are left alone
+        :return: False if the rate is not positive
+        """
+        if rate <= 0:
+            return False
+        bank = self.bank
+        if scope is None:
+            scope = channels if channels else bank.all_mask
+        with self.cond:
+            self.effect = iter(effect)
+            self.interval = 1.0 / rate
+            self.channels = channels
+            self.scope = scope & bank.all_mask
+            self.origin = monotonic()
+            self.tick = 0
+            self.bank_generation = bank.pulse_generation
+            self._changed()
+        return True
+
+    def stop(self):
+        """
+        Stops the effect playing, leaving its channels as they are
+        :return: nil
+        """
+        with self.cond:
+            self.effect = None
+            self._changed()
+
+    def close(self):
+        """
+        Stops the effect and ends the thread
+        :return: nil
+        """
+        with self.cond:
+            self.effect = None
+            self.running = False
+            self._changed()
+        self.thread.join()
+
+    def _changed(self):
+        self.generation += 1
+        self.cond.notify()
+
+    def run(self):
+        """
+        Thread body, applies a frame at every tick. Ticks are timed from the start so they do not drift, and
+        frames missed by a late wakeup are skipped.
+        :return: nil
+        """
+        RealTime.enter('player')
+        bank = self.bank
+        while True:
+            with self.cond:
+                while self.running and self.effect is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                deadline = self.origin + self.tick * self.interval
+                timeout = deadline - monotonic() - self.spin
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+                generation = self.generation
+
+            now = spin_until(deadline)
+
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                if self.bank_generation != bank.pulse_generation:
+                    self.effect = None  # the bank was killed
+                    continue
+                effect = self.effect
+                late = max(0, int((now - self.origin) / self.interval) - self.tick)
+                try:
+                    for i in range(late):
+                        next(effect)
+                    mask = next(effect)
+                except StopIteration:
+                    self.effect = None
+                    continue
+                except Exception as e:
+                    PuffLog.error('pattern_failed', error=repr(e))
+                    self.effect = None
+                    continue
+                self.tick += late + 1
+                frame = spread(mask, self.channels) & self.scope
+                with bank.lock:
+                    if self.bank_generation == bank.pulse_generation:
+                        bank.set_mask((bank.state_mask & ~self.scope) | frame)
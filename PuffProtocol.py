@@ -0,0 +1,585 @@
+"""
+The Puff binary command protocol.
+
+Every command is a frame made of a 3 byte header followed by a payload:
+    length  - 2 bytes, big-endian, number of payload bytes after the header
+    opcode  - 1 byte, one of the OP_ constants below
+    payload - fixed layout per opcode, see PAYLOADS
+
+Over UDP each datagram starts with a 4 byte big-endian sequence number (SEQUENCE) followed by one or
+more complete frames.
+
+CommandParser turns a stream of bytes (with frames split or coalesced in any way by TCP) into
+(opcode, args) calls on a handler. CommandProcessor is the handler that applies commands to a
+GPIOFireBank and builds replies, timing every command with a PuffMetrics. The encode_ functions build
+frames for clients.
+"""
+import struct
+from time import monotonic_ns
+
+import PuffLog
+from PuffMacros import Macro
+from PuffMetrics import PuffMetrics
+from PuffPatterns import EFFECTS, make_effect
+from Show import Show
+from ShowValidator import validate
+
+__author__ = 'Stu D\'Alessandro'
+
+
+# Commands (client to Puff)
+OP_SET_CHANNEL = 0x01       # channel (1-based), state (0 or 1)
+OP_SET_MASK = 0x02          # state of every channel as a bit mask, bit 0 is channel 1
+OP_KILL_ALL = 0x03          # turn every channel off
+OP_SET_MAX_ON_TIME = 0x04   # max on time in milliseconds
+OP_QUERY = 0x05             # ask for an OP_STATE reply
+OP_SET_WIDE_MASK = 0x06     # like OP_SET_MASK for up to 256 channels, four 64 bit words, channels 1-64 first
+OP_WIDE_QUERY = 0x07        # ask for an OP_WIDE_STATE reply
+OP_PULSE_CHANNEL = 0x08     # channel (1-based), open ms, number of pulses, closed ms between pulses
+OP_PULSE_MASK = 0x09        # mask, open ms, number of pulses, closed ms between pulses
+
+# Show upload and playback (client to Puff)
+OP_SHOW_BEGIN = 0x10        # discard any partial upload and start a new show
+OP_SHOW_CUE = 0x11          # time in milliseconds from the start of the show, state mask from then on
+OP_SHOW_END = 0x12          # validate the upload and load it into the player, stopping any show playing
+OP_SHOW_START = 0x13        # play from the current position, resuming if paused
+OP_SHOW_STOP = 0x14         # stop and rewind, all channels off
+OP_SHOW_PAUSE = 0x15        # hold the current position, all channels off
+OP_SHOW_SEEK = 0x16         # position in milliseconds
+OP_SHOW_QUERY = 0x17        # ask for an OP_SHOW_STATE reply
+OP_SHOW_START_AT = 0x18     # play from the current position when the leader clock reads this time (ns)
+OP_CLOCK_QUERY = 0x19       # ask for an OP_CLOCK reply
+OP_STATS_QUERY = 0x1A       # ask for an OP_STATS reply
+
+# Macros (client to Puff), names are up to 8 ASCII bytes padded with zeros
+OP_MACRO_BEGIN = 0x1B       # name, discard any partial definition and start a new macro
+OP_MACRO_STEP = 0x1C        # time ms from the start of the macro, logical mask, pulse ms (0 sets the mask)
+OP_MACRO_END = 0x1D         # period ms between repeats (0 for the time of the last step), store the macro
+OP_MACRO_RUN = 0x1E         # name, speed percent (100 as defined), bank mask to map onto (0 all), repeats (0 forever)
+OP_MACRO_STOP = 0x1F        # name, all zeros to stop every macro
+
+# Effects (client to Puff), see PuffPatterns.make_effect
+OP_PATTERN_PLAY = 0x20      # effect number (index in EFFECTS), ticks per second x 100, bank mask to map onto
+                            # (0 all), three effect parameters; replaces any effect playing
+OP_PATTERN_STOP = 0x21      # stop the effect playing, leaving its channels as they are
+
+# Replies (Puff to client)
+OP_STATE = 0x81             # mask, number of channels, max on time in milliseconds
+OP_SHOW_STATE = 0x82        # player state (0 stopped, 1 playing, 2 paused), position ms, number of cues
+OP_CLOCK = 0x83             # leader clock now (ns), 1 if this node is synchronized to the leader
+OP_WIDE_STATE = 0x84        # mask as four 64 bit words, number of channels, max on time in milliseconds
+OP_STATS = 0x85             # commands, bytes and watchdog forced-offs so far, commands/sec and bytes/sec,
+                            # then receive to GPIO write latency p50, p99, p99.9 and max in microseconds,
+                            # rates and latencies over the last completed metrics window
+OP_ERROR = 0xFF             # opcode that failed, error code
+
+# Error codes sent with OP_ERROR
+ERR_UNKNOWN_OPCODE = 1
+ERR_BAD_LENGTH = 2
+ERR_BAD_CHANNEL = 3
+ERR_NO_SHOW = 4             # no player, no upload in progress or no show loaded
+ERR_BAD_CUE = 5             # cue earlier than the one before it, or a macro period shorter than its steps
+ERR_UNAVAILABLE = 6         # the command needs something this node is not running, e.g. the watchdog timer,
+                            # or a cluster clock that is synchronized
+ERR_BUSY = 7                # the command queue is full, the command was not run
+ERR_NO_MACRO = 8            # no such macro, or no macro definition in progress
+ERR_BAD_SHOW = 9            # uploaded show keeps a channel on longer than max on time, or on after its last cue
+ERR_BAD_PATTERN = 10        # unknown effect number, or a parameter out of range
+
+# commands that only read state; a client sending nothing else is not controlling the bank, so its channels are
+# left alone when it disconnects. Add every new query opcode here.
+QUERY_OPS = (OP_QUERY, OP_WIDE_QUERY, OP_SHOW_QUERY, OP_CLOCK_QUERY, OP_STATS_QUERY)
+
+HEADER = struct.Struct('!HB')
+SEQUENCE = struct.Struct('!I')
+
+PAYLOADS = {
+    OP_SET_CHANNEL: struct.Struct('!BB'),
+    OP_SET_MASK: struct.Struct('!Q'),
+    OP_KILL_ALL: struct.Struct('!'),
+    OP_SET_MAX_ON_TIME: struct.Struct('!I'),
+    OP_QUERY: struct.Struct('!'),
+    OP_SET_WIDE_MASK: struct.Struct('!4Q'),
+    OP_WIDE_QUERY: struct.Struct('!'),
+    OP_PULSE_CHANNEL: struct.Struct('!BHHH'),
+    OP_PULSE_MASK: struct.Struct('!QHHH'),
+    OP_SHOW_BEGIN: struct.Struct('!'),
+    OP_SHOW_CUE: struct.Struct('!IQ'),
+    OP_SHOW_END: struct.Struct('!'),
+    OP_SHOW_START: struct.Struct('!'),
+    OP_SHOW_STOP: struct.Struct('!'),
+    OP_SHOW_PAUSE: struct.Struct('!'),
+    OP_SHOW_SEEK: struct.Struct('!I'),
+    OP_SHOW_QUERY: struct.Struct('!'),
+    OP_SHOW_START_AT: struct.Struct('!q'),
+    OP_CLOCK_QUERY: struct.Struct('!'),
+    OP_STATS_QUERY: struct.Struct('!'),
+    OP_MACRO_BEGIN: struct.Struct('!8s'),
+    OP_MACRO_STEP: struct.Struct('!IQH'),
+    OP_MACRO_END: struct.Struct('!I'),
+    OP_MACRO_RUN: struct.Struct('!8sHQH'),
+    OP_MACRO_STOP: struct.Struct('!8s'),
+    OP_PATTERN_PLAY: struct.Struct('!BHQhhh'),
+    OP_PATTERN_STOP: struct.Struct('!'),
+    OP_STATE: struct.Struct('!QBI'),
+    OP_SHOW_STATE: struct.Struct('!BII'),
+    OP_CLOCK: struct.Struct('!qB'),
+    OP_WIDE_STATE: struct.Struct('!4QHI'),
+    OP_STATS: struct.Struct('!QQIIIIIII'),
+    OP_ERROR: struct.Struct('!BB'),
+}
+
+
+WORD = 0xFFFFFFFFFFFFFFFF
+
+
+class ProtocolError(Exception):
+    """ Raised when a stream can no longer be framed, e.g. a frame larger than the parse buffer """
+    pass
+
+
+def encode(opcode, *args):
+    """
+    Builds one frame
+    :param opcode: one of the OP_ constants
+    :param args: payload values in the order given by PAYLOADS
+    :return: frame bytes
+    """
+    payload = PAYLOADS[opcode]
+    return HEADER.pack(payload.size, opcode) + payload.pack(*args)
+
+
+def encode_datagram(sequence, *frames):
+    """
+    Builds one UDP datagram
+    :param sequence: sender sequence number, incremented for every new datagram (not for resends)
+    :param frames: frames built by the other encode functions
+    :return: datagram bytes
+    """
+    return SEQUENCE.pack(sequence & 0xFFFFFFFF) + b''.join(frames)
+
+
+def encode_set_channel(channel_num, state):
+    return encode(OP_SET_CHANNEL, channel_num, 1 if state else 0)
+
+
+def encode_set_mask(mask):
+    return encode(OP_SET_MASK, mask)
+
+
+def encode_set_wide_mask(mask):
+    return encode(OP_SET_WIDE_MASK, mask & WORD, (mask >> 64) & WORD, (mask >> 128) & WORD, (mask >> 192) & WORD)
+
+
+def join_wide_mask(words):
+    """
+    :param words: four 64 bit words from an OP_SET_WIDE_MASK or OP_WIDE_STATE payload
+    :return: the mask as one integer
+    """
+    return words[0] | (words[1] << 64) | (words[2] << 128) | (words[3] << 192)
+
+
+def encode_pulse_channel(channel_num, duration, count=1, gap=0.0):
+    return encode(OP_PULSE_CHANNEL, channel_num, int(round(duration * 1000)), count, int(round(gap * 1000)))
+
+
+def encode_pulse_mask(mask, duration, count=1, gap=0.0):
+    return encode(OP_PULSE_MASK, mask, int(round(duration * 1000)), count, int(round(gap * 1000)))
+
+
+def encode_kill_all():
+    return encode(OP_KILL_ALL)
+
+
+def encode_set_max_on_time(seconds):
+    return encode(OP_SET_MAX_ON_TIME, int(round(seconds * 1000)))
+
+
+def encode_query():
+    return encode(OP_QUERY)
+
+
+def encode_stats_query():
+    return encode(OP_STATS_QUERY)
+
+
+def encode_macro(macro):
+    """
+    Builds the frames that define a macro on a node
+    :param macro: Macro
+    :return: bytes
+    """
+    frames = [encode(OP_MACRO_BEGIN, macro.name.encode('ascii'))]
+    for i in range(len(macro)):
+        frames.append(encode(OP_MACRO_STEP, int(round(macro.times[i] * 1000)), macro.masks[i],
+                             int(round(macro.pulses[i] * 1000))))
+    frames.append(encode(OP_MACRO_END, int(round(macro.period * 1000)) if macro.period is not None else 0))
+    return b''.join(frames)
+
+
+def encode_macro_run(name, speed=1.0, channels=0, repeat=1):
+    return encode(OP_MACRO_RUN, name.encode('ascii'), int(round(speed * 100)), channels, repeat)
+
+
+def encode_pattern_play(name, rate=20.0, channels=0, *params):
+    """
+    :param name: one of PuffPatterns.EFFECTS
+    :param rate: ticks per second
+    :param channels: bank mask the effect is mapped onto, 0 for the whole bank
+    :param params: up to three integer effect parameters, 0 for the ones left out
+    :return: frame bytes
+    """
+    params = (tuple(params) + (0, 0, 0))[:3]
+    return encode(OP_PATTERN_PLAY, EFFECTS.index(name), int(round(rate * 100)), channels, *params)
+
+
+def encode_show(show):
+    """
+    Builds the frames that upload a whole show
+    :param show: Show
+    :return: bytes
+    """
+    frames = [encode(OP_SHOW_BEGIN)]
+    for i in range(len(show)):
+        frames.append(encode(OP_SHOW_CUE, int(round(show.time_at(i) * 1000)), show.mask_at(i)))
+    frames.append(encode(OP_SHOW_END))
+    return b''.join(frames)
+
+
+class CommandParser(object):
+    """
+    Frames a byte stream into commands. Bytes are received straight into one buffer that is allocated up
+    front and reused (receive(), or feed() for bytes that are already in memory); each complete frame is
+    unpacked in place with the precompiled Structs in PAYLOADS and handed to the handler as
+    handler(opcode, args). args is None when the opcode is unknown or the payload length does not match the
+    opcode. The only objects created per frame are the args tuple and its values.
+    """
+    def __init__(self, handler, bufsize=4096):
+        """
+        :param handler: callable taking (opcode, args)
+        :param bufsize: size of the receive buffer, also the largest frame accepted
+        :return: nil
+        """
+        self.handler = handler
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.count = 0  # number of bytes held in buf
+
+    def reset(self):
+        """
+        Discards any partial frame, e.g. when a new client connects
+        :return: nil
+        """
+        self.count = 0
+
+    def feed(self, data):
+        """
+        Adds received bytes and dispatches every complete frame
+        :param data: bytes as received from the socket, any length
+        :return: number of frames dispatched
+        """
+        frames = 0
+        offset = 0
+        remaining = len(data)
+        while remaining > 0:
+            room = len(self.buf) - self.count
+            if room == 0:
+                raise ProtocolError('Frame larger than the {0} byte parse buffer'.format(len(self.buf)))
+            n = min(room, remaining)
+            self.buf[self.count:self.count + n] = data[offset:offset + n]
+            self.count += n
+            offset += n
+            remaining -= n
+            frames += self.drain()
+        return frames
+
+    def receive(self, sock, nbytes=0):
+        """
+        Receives from a socket directly into the free end of the buffer, without dispatching; call drain()
+        next
+        :param sock: connected stream socket
+        :param nbytes: most bytes to receive, 0 for as many as fit
+        :return: number of bytes received, 0 when the peer has closed the connection
+        """
+        room = len(self.buf) - self.count
+        if room == 0:
+            raise ProtocolError('Frame larger than the {0} byte parse buffer'.format(len(self.buf)))
+        n = sock.recv_into(self.view[self.count:], nbytes if 0 < nbytes < room else room)
+        self.count += n
+        return n
+
+    def drain(self):
+        """
+        Dispatches complete frames from the front of the buffer and moves any partial frame to the front
+        :return: number of frames dispatched
+        """
+        buf = self.buf
+        pos, frames = self.parse(buf, 0, self.count)
+        if self.count - pos >= HEADER.size:
+            length = HEADER.unpack_from(buf, pos)[0]
+            if HEADER.size + length > len(buf):
+                raise ProtocolError('Frame of {0} bytes is larger than the parse buffer'.format(length))
+
+        if pos > 0:
+            self.count -= pos
+            if self.count > 0:
+                # memoryview slices move the partial frame without an intermediate copy
+                self.view[0:self.count] = self.view[pos:pos + self.count]
+        return frames
+
+    def parse(self, buf, start, end):
+        """
+        Dispatches the complete frames found in buf[start:end] without copying them
+        :param buf: any buffer holding frames
+        :param start: offset of the first frame
+        :param end: offset just past the last received byte
+        :return: (offset of the first incomplete frame, number of frames dispatched)
+        """
+        handler = self.handler
+        pos = start
+        frames = 0
+        while end - pos >= HEADER.size:
+            length, opcode = HEADER.unpack_from(buf, pos)
+            frame_end = pos + HEADER.size + length
+            if frame_end > end:
+                break
+            payload = PAYLOADS.get(opcode)
+            if payload is None or payload.size != length:
+                handler(opcode, None)
+            else:
+                handler(opcode, payload.unpack_from(buf, pos + HEADER.size))
+            frames += 1
+            pos = frame_end
+        return pos, frames
+
+
+class CommandProcessor(object):
+    """ Applies decoded commands to a GPIOFireBank and its ShowPlayer """
+    def __init__(self, bank, player=None, clock=None, metrics=None, macros=None, patterns=None):
+        """
+        :param bank: the GPIOFireBank to drive
+        :param player: ShowPlayer for show commands, or None to refuse them
+        :param clock: ClockLeader or ClockFollower that maps leader time to local time, None if this node
+        is its own leader
+        :param metrics: PuffMetrics to record command latencies in, a new one if None
+        :param macros: MacroPlayer for macro commands, or None to refuse them
+        :param patterns: PatternPlayer for effect commands, or None to refuse them
+        :return: nil
+        """
+        self.bank = bank
+        self.player = player
+        self.clock = clock
+        self.metrics = metrics if metrics is not None else PuffMetrics(bank)
+        self.macros = macros
+        self.patterns = patterns
+        self.upload = None  # Show being uploaded
+        self.macro_upload = None  # Macro being defined
+
+    def __call__(self, opcode, args):
+        """
+        Executes one command and records its latency. The network layer calls metrics.received() when the
+        bytes holding the command arrive.
+        :param opcode: one of the OP_ constants
+        :param args: unpacked payload, or None if the payload could not be decoded
+        :return: reply frame bytes, or None if the command has no reply
+        """
+        # commands run as soon as they are parsed, so they are dispatched at the same time
+        parsed = monotonic_ns()
+        reply = self.execute(opcode, args)
+        self.metrics.command(self.metrics.recv_ns, parsed, parsed, self.bank.last_write_ns)
+        return reply
+
+    def execute(self, opcode, args):
+        """
+        Executes one command
+        :param opcode: one of the OP_ constants
+        :param args: unpacked payload, or None if the payload could not be decoded
+        :return: reply frame bytes, or None if the command has no reply
+        """
+        if args is None:
+            if opcode in PAYLOADS:
+                return encode(OP_ERROR, opcode & 0xFF, ERR_BAD_LENGTH)
+            return encode(OP_ERROR, opcode & 0xFF, ERR_UNKNOWN_OPCODE)
+
+        bank = self.bank
+        if opcode == OP_SET_CHANNEL:
+            if bank.set_channel_state(args[0], args[1]) is False:
+                return encode(OP_ERROR, opcode, ERR_BAD_CHANNEL)
+        elif opcode == OP_SET_MASK:
+            bank.set_mask(args[0])
+        elif opcode == OP_KILL_ALL:
+            if self.player is not None:
+                self.player.stop()
+            bank.kill()
+        elif opcode == OP_SET_MAX_ON_TIME:
+            bank.set_max_on_time(args[0] / 1000.0)
+        elif opcode == OP_QUERY:
+            return self.state_reply()
+        elif opcode == OP_PULSE_CHANNEL or opcode == OP_PULSE_MASK:
+            if opcode == OP_PULSE_CHANNEL:
+                if not 0 < args[0] <= bank.num_channels:
+                    return encode(OP_ERROR, opcode, ERR_BAD_CHANNEL)
+                mask = 1 << (args[0] - 1)
+            else:
+                mask = args[0]
+            if not bank.pulse(mask, args[1] / 1000.0, args[2], args[3] / 1000.0):
+                return encode(OP_ERROR, opcode, ERR_UNAVAILABLE)
+        elif opcode == OP_SET_WIDE_MASK:
+            bank.set_mask(join_wide_mask(args))
+        elif opcode == OP_WIDE_QUERY:
+            mask = bank.get_mask()
+            return encode(OP_WIDE_STATE, mask & WORD, (mask >> 64) & WORD, (mask >> 128) & WORD,
+                          (mask >> 192) & WORD, bank.num_channels, int(round(bank.max_on_time * 1000)))
+        elif OP_SHOW_BEGIN <= opcode <= OP_SHOW_START_AT:
+            return self.show_command(opcode, args)
+        elif opcode == OP_CLOCK_QUERY:
+            now = monotonic_ns()
+            if self.clock is None:
+                return encode(OP_CLOCK, now, 1)
+            return encode(OP_CLOCK, self.clock.to_leader(now), 1 if self.clock.synchronized() else 0)
+        elif opcode == OP_STATS_QUERY:
+            return self.stats_reply()
+        elif OP_MACRO_BEGIN <= opcode <= OP_MACRO_STOP:
+            return self.macro_command(opcode, args)
+        elif opcode == OP_PATTERN_PLAY or opcode == OP_PATTERN_STOP:
+            return self.pattern_command(opcode, args)
+        else:
+            return encode(OP_ERROR, opcode, ERR_UNKNOWN_OPCODE)
+        return None
+
+    def show_command(self, opcode, args):
+        """
+        Executes a show upload or playback command
+        :param opcode: one of the OP_SHOW_ constants
+        :param args: unpacked payload
+        :return: reply frame bytes, or None if the command has no reply
+        """
+        player = self.player
+        if player is None:
+            return encode(OP_ERROR, opcode, ERR_NO_SHOW)
+
+        if opcode == OP_SHOW_BEGIN:
+            self.upload = Show()
+        elif opcode == OP_SHOW_CUE:
+            if self.upload is None:
+                return encode(OP_ERROR, opcode, ERR_NO_SHOW)
+            if not self.upload.add_cue(args[0] / 1000.0, args[1] & self.bank.all_mask):
+                return encode(OP_ERROR, opcode, ERR_BAD_CUE)
+        elif opcode == OP_SHOW_END:
+            if self.upload is None:
+                return encode(OP_ERROR, opcode, ERR_NO_SHOW)
+            upload = self.upload
+            self.upload = None
+            # refuse choreography the watchdog would cut short, before any of it plays
+            report = validate(upload, self.bank.num_channels, self.bank.max_on_time)
+            if not report.ok():
+                PuffLog.warning('show_rejected', cues=len(upload), problems=len(report.problems),
+                                first=report.problems[0])
+                return encode(OP_ERROR, opcode, ERR_BAD_SHOW)
+            player.load(upload)
+        elif opcode == OP_SHOW_START:
+            if not player.start():
+                return encode(OP_ERROR, opcode, ERR_NO_SHOW)
+        elif opcode == OP_SHOW_STOP:
+            player.stop()
+        elif opcode == OP_SHOW_PAUSE:
+            player.pause()
+        elif opcode == OP_SHOW_SEEK:
+            player.seek(args[0] / 1000.0)
+        elif opcode == OP_SHOW_START_AT:
+            leader_ns = args[0]
+            if self.clock is not None and not self.clock.synchronized():
+                # without samples the mapping is the identity, which would start at an arbitrary point
+                return encode(OP_ERROR, opcode, ERR_UNAVAILABLE)
+            local_ns = leader_ns if self.clock is None else self.clock.to_local(leader_ns)
+            if not player.start(local_ns / 1e9):
+                return encode(OP_ERROR, opcode, ERR_NO_SHOW)
+        elif opcode == OP_SHOW_QUERY:
+            show = player.show
+            return encode(OP_SHOW_STATE, player.state, int(round(player.current_position() * 1000)),
+                          len(show) if show is not None else 0)
+        return None
+
+    def macro_command(self, opcode, args):
+        """
+        Executes a macro definition or playback command
+        :param opcode: one of the OP_MACRO_ constants
+        :param args: unpacked payload
+        :return: reply frame bytes, or None if the command has no reply
+        """
+        macros = self.macros
+        if macros is None:
+            return encode(OP_ERROR, opcode, ERR_NO_MACRO)
+
+        if opcode == OP_MACRO_BEGIN:
+            self.macro_upload = Macro(args[0].rstrip(b'\0').decode('ascii', 'replace'))
+        elif opcode == OP_MACRO_STEP:
+            if self.macro_upload is None:
+                return encode(OP_ERROR, opcode, ERR_NO_MACRO)
+            if not self.macro_upload.add_step(args[0] / 1000.0, args[1], args[2] / 1000.0):
+                return encode(OP_ERROR, opcode, ERR_BAD_CUE)
+        elif opcode == OP_MACRO_END:
+            if self.macro_upload is None:
+                return encode(OP_ERROR, opcode, ERR_NO_MACRO)
+            if args[0] and not self.macro_upload.set_period(args[0] / 1000.0):
+                return encode(OP_ERROR, opcode, ERR_BAD_CUE)
+            macros.define(self.macro_upload)
+            self.macro_upload = None
+        elif opcode == OP_MACRO_RUN:
+            name = args[0].rstrip(b'\0').decode('ascii', 'replace')
+            if name not in macros.macros:
+                return encode(OP_ERROR, opcode, ERR_NO_MACRO)
+            if not macros.run(name, args[1] / 100.0, args[2], args[3]):
+                return encode(OP_ERROR, opcode, ERR_UNAVAILABLE)
+        elif opcode == OP_MACRO_STOP:
+            name = args[0].rstrip(b'\0').decode('ascii', 'replace')
+            macros.stop(name or None)
+        return None
+
+    def pattern_command(self, opcode, args):
+        """
+        Starts or stops an effect
+        :param opcode: OP_PATTERN_PLAY or OP_PATTERN_STOP
+        :param args: unpacked payload
+        :return: reply frame bytes, or None if the command has no reply
+        """
+        patterns = self.patterns
+        if patterns is None:
+            return encode(OP_ERROR, opcode, ERR_UNAVAILABLE)
+
+        if opcode == OP_PATTERN_PLAY:
+            number, rate, channels = args[:3]
+            channels &= self.bank.all_mask
+            num_channels = bin(channels).count('1') if channels else self.bank.num_channels
+            try:
+                if number >= len(EFFECTS):
+                    raise ValueError('no effect {0}'.format(number))
+                effect = make_effect(EFFECTS[number], num_channels, *args[3:])
+            except ValueError:
+                return encode(OP_ERROR, opcode, ERR_BAD_PATTERN)
+            if not patterns.play(effect, rate / 100.0, channels):
+                return encode(OP_ERROR, opcode, ERR_BAD_PATTERN)
+        elif opcode == OP_PATTERN_STOP:
+            patterns.stop()
+        return None
+
+    def state_reply(self):
+        """
+        Builds an OP_STATE frame describing the bank, limited to the first 64 channels
+        :return: frame bytes
+        """
+        bank = self.bank
+        return encode(OP_STATE, bank.get_mask() & WORD, min(bank.num_channels, 255),
+                      int(round(bank.max_on_time * 1000)))
+
+    def stats_reply(self):
+        """
+        Builds an OP_STATS frame from the metrics
+        :return: frame bytes
+        """
+        metrics = self.metrics
+        total = metrics.window['total']
+        return encode(OP_STATS, metrics.commands, metrics.bytes, metrics.forced_offs() & 0xFFFFFFFF,
+                      min(int(metrics.rates[0]), 0xFFFFFFFF), min(int(metrics.rates[1]), 0xFFFFFFFF),
+                      *[min(value // 1000, 0xFFFFFFFF) for value in
+                        (total.percentile(0.5), total.percentile(0.99), total.percentile(0.999), total.max)])
@@ -0,0 +1,409 @@
+"""
+Event loop TCP server for Puff.
+PuffServer accepts any number of clients on one thread using the selectors module. Every connection has its
+own CommandParser, but all of them feed the same CommandProcessor, so commands from all clients reach the
+GPIOFireBank one at a time in the order they were received. Given a CommandQueue, the event loop only decodes
+and queues commands and a PuffOutput.OutputThread executes them, so a client flooding the node cannot hold up
+the others; replies are passed back to the event loop to be sent.
+PuffDatagramListener optionally adds a UDP socket to the same loop for cues that need low, steady latency
+more than guaranteed delivery.
+"""
+import selectors
+import socket
+from collections import deque
+from time import monotonic, monotonic_ns
+
+import PuffLog
+from PuffOutput import OutputThread
+from PuffProtocol import CommandParser, CommandProcessor, ProtocolError, encode, OP_ERROR, QUERY_OPS, SEQUENCE, \
+    ERR_BUSY, OP_KILL_ALL
+
+__author__ = 'Stu D\'Alessandro'
+
+
+class PuffConnection(object):
+    """ State for one connected client """
+    def __init__(self, server, sock, addr):
+        """
+        :param server: the PuffServer that accepted this connection
+        :param sock: connected, non-blocking socket
+        :param addr: client address
+        :return: nil
+        """
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.outbox = bytearray()  # replies not yet accepted by the socket
+        self.controller = False  # set once this client sends anything that changes the bank
+        self.queued = 0  # commands waiting in the server's command queue
+        self.parser = CommandParser(self.handle)
+
+    def handle(self, opcode, args):
+        """
+        Parser callback, runs or queues the command and sends any reply
+        :param opcode: command opcode
+        :param args: unpacked payload or None
+        :return: nil
+        """
+        if opcode not in QUERY_OPS:
+            self.controller = True
+        server = self.server
+        if server.queue is None:
+            reply = server.processor(opcode, args)
+            if reply is not None:
+                self.send(reply)
+        elif not server.queue.put(opcode, args, server.metrics.recv_ns, monotonic_ns(), self):
+            self.send(encode(OP_ERROR, opcode & 0xFF, ERR_BUSY))
+
+    def reply(self, data, address=None):
+        """
+        Sends the reply to a queued command, called from the output thread
+        :param data: reply frame
+        :param address: unused
+        :return: nil
+        """
+        self.server.post_reply(self, data)
+
+    def send(self, data):
+        """
+        Sends data without blocking, keeping whatever the socket does not accept for later
+        :param data: bytes to send
+        :return: nil
+        """
+        if not self.outbox:
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            if sent == len(data):
+                return
+            data = data[sent:]
+        self.outbox += data
+        self.server.want_write(self, True)
+
+    def flush(self):
+        """
+        Sends queued replies when the socket becomes writable
+        :return: nil
+        """
+        try:
+            sent = self.sock.send(self.outbox)
+        except BlockingIOError:
+            return
+        del self.outbox[:sent]
+        if not self.outbox:
+            self.server.want_write(self, False)
+
+
+class PuffDatagramListener(object):
+    """
+    Accepts sequenced command datagrams on a UDP socket. Datagrams are received into one reusable buffer and
+    their frames are parsed in place. Per sender, a datagram whose sequence number is not newer than the last
+    one applied is dropped, so late, reordered and duplicated datagrams never reach the bank.
+    """
+    def __init__(self, server, addr, bufsize=1500, sender_timeout=5.0, max_senders=1024):
+        """
+        :param server: the PuffServer whose processor runs the commands
+        :param addr: (host, port) to listen on
+        :param bufsize: largest datagram accepted
+        :param sender_timeout: seconds of silence after which a sender's sequence is forgotten, so a
+        restarted sender is accepted again
+        :param max_senders: most senders whose sequence is remembered at once
+        :return: nil
+        """
+        self.server = server
+        self.buf = bytearray(bufsize)
+        self.sender_timeout = sender_timeout
+        self.max_senders = max_senders
+        self.senders = {}  # sender address -> [last sequence, time of last datagram]
+        self.swept_at = 0.0  # monotonic time senders were last checked for silence
+        self.dropped = 0
+        self.reply_to = None
+        self.queued = 0  # commands waiting in the server's command queue
+        self.parser = CommandParser(self.handle, 0)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.setblocking(False)
+        self.addr = self.sock.getsockname()
+
+    def handle(self, opcode, args):
+        """
+        Parser callback, runs the command and answers the sender if there is a reply
+        :param opcode: command opcode
+        :param args: unpacked payload or None
+        :return: nil
+        """
+        server = self.server
+        if server.queue is None:
+            reply = server.processor(opcode, args)
+            if reply is not None:
+                self.reply(reply, self.reply_to)
+        elif not server.queue.put(opcode, args, server.metrics.recv_ns, monotonic_ns(), self, self.reply_to):
+            self.reply(encode(OP_ERROR, opcode & 0xFF, ERR_BUSY), self.reply_to)
+
+    def reply(self, data, address):
+        """
+        Answers a sender, from either thread
+        :param data: reply frame
+        :param address: sender address
+        :return: nil
+        """
+        try:
+            self.sock.sendto(data, address)
+        except OSError:
+            pass
+
+    def accept_sequence(self, sender, sequence, now):
+        """
+        Decides whether a datagram is newer than the last one applied from its sender
+        :param sender: sender address
+        :param sequence: sequence number of the datagram
+        :param now: monotonic time the datagram arrived
+        :return: True if the datagram should be applied
+        """
+        state = self.senders.get(sender)
+        if state is None:
+            if len(self.senders) >= self.max_senders or now - self.swept_at > self.sender_timeout:
+                self.forget_senders(now)
+            self.senders[sender] = [sequence, now]
+            return True
+        if now - state[1] > self.sender_timeout:
+            state[0] = sequence
+            state[1] = now
+            return True
+        # serial number arithmetic, so the 32 bit sequence can wrap
+        delta = (sequence - state[0]) & 0xFFFFFFFF
+        if delta == 0 or delta >= 0x80000000:
+            return False
+        state[0] = sequence
+        state[1] = now
+        return True
+
+    def forget_senders(self, now):
+        """
+        Forgets senders that have been silent for longer than sender_timeout, which would be accepted afresh
+        anyway, and the longest silent ones beyond max_senders, so any host on the network cannot grow the
+        table without limit
+        :param now: monotonic time
+        :return: nil
+        """
+        senders = self.senders
+        for sender in [sender for sender, state in senders.items() if now - state[1] > self.sender_timeout]:
+            del senders[sender]
+        if len(senders) >= self.max_senders:
+            by_age = sorted(senders, key=lambda sender: senders[sender][1])
+            for sender in by_age[:len(senders) - self.max_senders + 1]:
+                del senders[sender]
+        self.swept_at = now
+
+    def service(self, sock, events):
+        """
+        Applies every datagram waiting on the socket
+        :return: nil
+        """
+        buf = self.buf
+        while True:
+            try:
+                nbytes, sender = sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if nbytes < SEQUENCE.size or not self.accept_sequence(sender, SEQUENCE.unpack_from(buf, 0)[0],
+                                                                   monotonic()):
+                self.dropped += 1
+                continue
+            self.reply_to = sender
+            self.server.metrics.received(nbytes)
+            self.parser.parse(buf, SEQUENCE.size, nbytes)
+
+    def close(self):
+        self.sock.close()
+
+
+class PuffServer(object):
+    """ Serves many Puff clients from one thread and one GPIOFireBank """
+    def __init__(self, bank, addr=('', 4444), bufsize=1024, udp_addr=None, player=None, clock=None,
+                 metrics=None, queue=None, macros=None, patterns=None):
+        """
+        :param bank: the GPIOFireBank all clients drive
+        :param addr: (host, port) to listen on
+        :param bufsize: bytes read from a client per receive
+        :param udp_addr: (host, port) for sequenced UDP commands, or None for TCP only
+        :param player: ShowPlayer for show commands, or None to refuse them
+        :param clock: ClockLeader or ClockFollower for synchronized show starts, None if not clustered
+        :param metrics: PuffMetrics that commands are timed in, a new one if None
+        :param queue: CommandQueue to run commands from an output thread, None to run them on the event loop
+        :param macros: MacroPlayer for macro commands, or None to refuse them
+        :param patterns: PatternPlayer for effect commands, or None to refuse them
+        :return: nil
+        """
+        self.bank = bank
+        self.processor = CommandProcessor(bank, player, clock, metrics, macros, patterns)
+        self.metrics = self.processor.metrics
+        self.queue = queue
+        self.replies = deque()  # (connection, frame) from the output thread
+        self.bufsize = bufsize
+        self.connections = {}
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(addr)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.addr = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ, self._accept)
+
+        # lets stop() wake the loop from another thread
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._woken)
+
+        self.datagrams = None
+        if udp_addr is not None:
+            self.datagrams = PuffDatagramListener(self, udp_addr)
+            self.selector.register(self.datagrams.sock, selectors.EVENT_READ, self.datagrams.service)
+
+        self.output = OutputThread(self.processor, queue) if queue is not None else None
+
+    def serve_forever(self):
+        """
+        Runs the event loop until stop() is called
+        :return: nil
+        """
+        self.running = True
+        while self.running:
+            for key, events in self.selector.select():
+                key.data(key.fileobj, events)
+        self.close()
+
+    def stop(self):
+        """
+        Asks the event loop to exit, safe to call from any thread
+        :return: nil
+        """
+        self.running = False
+        self._wake()
+
+    def post_reply(self, conn, data):
+        """
+        Hands a reply to the event loop to send, safe to call from any thread
+        :param conn: PuffConnection
+        :param data: reply frame
+        :return: nil
+        """
+        self.replies.append((conn, data))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except (BlockingIOError, OSError):
+            pass  # the loop is already due to wake up, or closed
+
+    def close(self):
+        """
+        Closes every connection and the listening socket
+        :return: nil
+        """
+        if self.output is not None:
+            self.output.close()
+        for conn in list(self.connections.values()):
+            self._drop(conn)
+        self.selector.close()
+        self.listener.close()
+        if self.datagrams is not None:
+            self.datagrams.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def want_write(self, conn, enable):
+        """
+        Turns write notifications on or off for a connection with queued replies
+        :param conn: PuffConnection
+        :param enable: True while conn has an outbox to flush
+        :return: nil
+        """
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if enable else selectors.EVENT_READ
+        self.selector.modify(conn.sock, events, self._service)
+
+    def _woken(self, sock, events):
+        try:
+            sock.recv(64)
+        except BlockingIOError:
+            pass
+        replies = self.replies
+        while replies:
+            conn, data = replies.popleft()
+            if self.connections.get(conn.sock.fileno()) is conn:
+                try:
+                    conn.send(data)
+                except OSError:
+                    # e.g. reset by the client while its reply was on the output thread
+                    PuffLog.warning('client_lost', addr=conn.addr)
+                    self._drop(conn)
+
+    def _accept(self, sock, events):
+        try:
+            cs, addr = sock.accept()
+        except BlockingIOError:
+            return
+        cs.setblocking(False)
+        cs.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = PuffConnection(self, cs, addr)
+        self.connections[cs.fileno()] = conn
+        self.selector.register(cs, selectors.EVENT_READ, self._service)
+        PuffLog.info('client_connected', addr=addr)
+
+    def _service(self, sock, events):
+        conn = self.connections.get(sock.fileno())
+        if conn is None:
+            return
+        try:
+            if events & selectors.EVENT_WRITE:
+                conn.flush()
+            if events & selectors.EVENT_READ:
+                nbytes = conn.parser.receive(sock, self.bufsize)
+                if nbytes == 0:
+                    PuffLog.info('client_disconnected', addr=conn.addr)
+                    self._drop(conn)
+                    return
+                self.metrics.received(nbytes)
+                conn.parser.drain()
+        except BlockingIOError:
+            pass
+        except ProtocolError as e:
+            PuffLog.warning('client_bad_data', addr=conn.addr, error=e)
+            self._drop(conn)
+        except OSError:
+            PuffLog.warning('client_lost', addr=conn.addr)
+            self._drop(conn)
+
+    def _drop(self, conn):
+        """
+        Closes a connection. If it was controlling the bank the cannons are turned off, by the output thread
+        when there is one so the kill comes after any command of the connection already running.
+        :param conn: PuffConnection
+        :return: nil
+        """
+        self.connections.pop(conn.sock.fileno(), None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        if self.queue is not None:
+            self.queue.forget(conn)
+            # a command of this connection may be executing on the output thread right now; queued behind it,
+            # the kill is ordered after it and cannot be undone by it
+            if conn.controller and self.queue.put(OP_KILL_ALL, (), monotonic_ns(), monotonic_ns(), conn):
+                PuffLog.warning('controller_dropped_all_off', addr=conn.addr)
+                return
+        if conn.controller:
+            self.bank.kill()
+            PuffLog.warning('controller_dropped_all_off', addr=conn.addr)
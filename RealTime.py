@@ -0,0 +1,153 @@
+"""
+Opt-in real-time mode for the threads that time valve edges.
+configure() locks the process's memory with mlockall so no page the output path touches is ever paged out,
+and records which core and SCHED_FIFO priority the timing threads should use. Each timing thread (output,
+show player, watchdog) calls enter() as it starts, which pins it to that core and raises it to SCHED_FIFO.
+Every step is attempted separately and a step the process is not allowed to do (no CAP_SYS_NICE or
+CAP_IPC_LOCK, a core outside the container's cpuset, a kernel without the call) is logged and skipped, so the
+same build runs unprivileged. measure_jitter() reports how late periodic wakeups actually are.
+
+Spinning threads at SCHED_FIFO can starve everything else on their core, so pick a core that is otherwise
+idle, e.g. one isolated with isolcpus, and keep the watchdog's spin short.
+"""
+import ctypes
+import ctypes.util
+import os
+import threading
+from time import monotonic
+
+import PuffLog
+from PrecisionTimer import SPIN, sleep_until
+
+__author__ = 'Stu D\'Alessandro'
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+PAGE_SIZE = 4096
+
+# SCHED_FIFO priority of each timing thread relative to the configured priority; the watchdog is the safety
+# net, so it preempts the others
+PRIORITY_OFFSETS = {'watchdog': 2, 'output': 1, 'player': 0}
+
+settings = None  # (cpu or None, priority) once configure() has been called
+
+
+def configure(cpu=None, priority=50, lock_memory=True):
+    """
+    Turns real-time mode on for the process. Call before the timing threads are started.
+    :param cpu: core to pin the timing threads to, None to leave them where the scheduler puts them
+    :param priority: SCHED_FIFO priority of the timing threads, 1-99
+    :param lock_memory: lock current and future memory with mlockall
+    :return: dict of what was achieved
+    """
+    global settings
+    settings = (cpu, priority)
+    result = {'memory_locked': False}
+    if lock_memory:
+        result['memory_locked'] = mlockall()
+    return result
+
+
+def enter(role):
+    """
+    Called by a timing thread as it starts. Does nothing unless configure() was called.
+    :param role: 'watchdog', 'output' or 'player'
+    :return: dict of what was achieved for this thread, None if real-time mode is off
+    """
+    if settings is None:
+        return None
+    cpu, priority = settings
+    result = {'cpu': None, 'fifo_priority': None}
+    if cpu is not None and pin_to_cpu(cpu):
+        result['cpu'] = cpu
+    wanted = max(1, min(99, priority + PRIORITY_OFFSETS.get(role, 0)))
+    if set_fifo(wanted):
+        result['fifo_priority'] = wanted
+    PuffLog.info('realtime_thread', role=role, **result)
+    return result
+
+
+def pin_to_cpu(cpu):
+    """
+    Pins the calling thread to one core
+    :param cpu: core number
+    :return: True if pinned
+    """
+    try:
+        os.sched_setaffinity(0, {cpu})
+        return True
+    except (AttributeError, OSError, ValueError) as e:
+        PuffLog.warning('realtime_unavailable', step='affinity', cpu=cpu, error=e)
+        return False
+
+
+def set_fifo(priority):
+    """
+    Moves the calling thread to the SCHED_FIFO real-time class
+    :param priority: 1-99
+    :return: True if the thread now runs under SCHED_FIFO
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except (AttributeError, OSError) as e:
+        PuffLog.warning('realtime_unavailable', step='sched_fifo', priority=priority, error=e)
+        return False
+
+
+def mlockall():
+    """
+    Locks every current and future page of the process in memory
+    :return: True if locked
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+            return True
+        error = os.strerror(ctypes.get_errno())
+    except (AttributeError, OSError) as e:
+        error = e
+    PuffLog.warning('realtime_unavailable', step='mlockall', error=error)
+    return False
+
+
+def prefault(*buffers):
+    """
+    Writes to every page of long-lived buffers so they are resident before the first cue needs them, which
+    matters most when mlockall was not permitted
+    :param buffers: bytearrays, arrays or other writable buffers
+    :return: nil
+    """
+    for buf in buffers:
+        view = memoryview(buf).cast('B')
+        for i in range(0, len(view), PAGE_SIZE):
+            view[i] = view[i]
+        view.release()
+
+
+def measure_jitter(samples=1000, period=0.001, role='output', spin=SPIN):
+    """
+    Times periodic wakeups on a thread set up like a timing thread
+    :param samples: number of wakeups
+    :param period: seconds between wakeups
+    :param role: role the measuring thread enters, so it runs with that thread's settings
+    :param spin: seconds spun before each wakeup, as the timing threads do
+    :return: dict of lateness p50_us, p99_us, max_us, and samples
+    """
+    lateness = []
+
+    def run():
+        enter(role)
+        deadline = monotonic() + period
+        for i in range(samples):
+            lateness.append(sleep_until(deadline, spin) - deadline)
+            deadline += period
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    lateness.sort()
+    return {'samples': samples,
+            'p50_us': round(lateness[len(lateness) // 2] * 1e6, 1),
+            'p99_us': round(lateness[min(len(lateness) - 1, int(len(lateness) * 0.99))] * 1e6, 1),
+            'max_us': round(lateness[-1] * 1e6, 1)}
@@ -0,0 +1,67 @@
+"""
+An in-memory show: a timed list of channel mask changes.
+Every cue holds the complete state of the bank from its time until the next cue, so the state at any point in
+a show is the mask of the last cue at or before it.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+__author__ = 'Stu D\'Alessandro'
+
+
+class Show(object):
+    """ Cues kept in two parallel arrays, times in seconds from the start of the show and state masks """
+    def __init__(self):
+        self.times = array('d')
+        self.masks = array('Q')
+
+    def add_cue(self, time, mask):
+        """
+        Appends a cue. Cues must be added in time order.
+        :param time: seconds from the start of the show
+        :param mask: state of every channel from this time on, bit 0 is channel 1
+        :return: True if the cue was added, False if it is earlier than the last cue
+        """
+        if self.times and time < self.times[-1]:
+            return False
+        self.times.append(time)
+        self.masks.append(mask)
+        return True
+
+    def __len__(self):
+        return len(self.times)
+
+    def time_at(self, index):
+        """
+        :param index: cue number
+        :return: time of that cue in seconds
+        """
+        return self.times[index]
+
+    def mask_at(self, index):
+        """
+        :param index: cue number
+        :return: state mask of that cue
+        """
+        return self.masks[index]
+
+    def duration(self):
+        """
+        :return: time of the last cue in seconds
+        """
+        return self.times[-1] if self.times else 0.0
+
+    def index_at(self, time):
+        """
+        :param time: seconds from the start of the show
+        :return: number of the first cue at or after time
+        """
+        return bisect_left(self.times, time)
+
+    def state_at(self, time):
+        """
+        :param time: seconds from the start of the show
+        :return: the state mask in effect at time
+        """
+        index = bisect_right(self.times, time)
+        return self.masks[index - 1] if index > 0 else 0
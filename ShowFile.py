@@ -0,0 +1,168 @@
+"""
+Compact binary show files, read through mmap.
+
+Layout, all little-endian:
+    header  - HEADER: magic, version, number of channels, tick rate (ticks per second), number of records,
+              index stride, number of index entries
+    records - RECORD per cue: ticks since the previous cue (u32), state mask (u64)
+    index   - INDEX_ENTRY for every index stride'th record: absolute tick (u64), record number (u32)
+
+ShowFile has the same cue methods as Show, so ShowPlayer plays either one. Nothing is read up front beyond the
+header: cue times are found from the sparse index plus at most one stride of deltas, and playing cues in
+order costs one record read per cue.
+"""
+import mmap
+import struct
+
+__author__ = 'Stu D\'Alessandro'
+
+MAGIC = b'PUFS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIII')
+RECORD = struct.Struct('<IQ')
+INDEX_ENTRY = struct.Struct('<QI')
+MAX_DELTA = 0xFFFFFFFF
+
+
+def write_show(path, show, num_channels, tick_rate=1000, index_stride=256):
+    """
+    Saves a show as a show file
+    :param path: file to write
+    :param show: Show, or anything with the same cue methods
+    :param num_channels: channels the show was written for
+    :param tick_rate: ticks per second, cue times are rounded to a tick
+    :param index_stride: records between index entries
+    :return: number of records written
+    """
+    count = len(show)
+    index_count = (count + index_stride - 1) // index_stride
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, num_channels, tick_rate, count, index_stride, index_count))
+        index = []
+        last_tick = 0
+        for i in range(count):
+            tick = int(round(show.time_at(i) * tick_rate))
+            delta = tick - last_tick
+            if delta < 0 or delta > MAX_DELTA:
+                raise ValueError('Cue {0} is out of order or too far after the one before it'.format(i))
+            if i % index_stride == 0:
+                index.append(INDEX_ENTRY.pack(tick, i))
+            f.write(RECORD.pack(delta, show.mask_at(i)))
+            last_tick = tick
+        f.write(b''.join(index))
+    return count
+
+
+class ShowFile(object):
+    """ A show file mapped into memory """
+    def __init__(self, path):
+        """
+        :param path: show file to open
+        :return: nil
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise ValueError('{0} is not a Puff show file'.format(path))
+        magic, version, self.num_channels, self.tick_rate, self.count, self.index_stride, self.index_count = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('{0} is not a version {1} Puff show file'.format(path, VERSION))
+        self.records_offset = HEADER.size
+        self.index_offset = HEADER.size + self.count * RECORD.size
+        if len(self.map) < self.index_offset + self.index_count * INDEX_ENTRY.size:
+            self.close()
+            raise ValueError('{0} is truncated'.format(path))
+        self.cursor = (-1, 0)  # (record number, absolute tick) of the last record whose time was found
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def tick_at(self, index):
+        """
+        :param index: record number
+        :return: absolute tick of that record
+        """
+        cursor_index, cursor_tick = self.cursor
+        if cursor_index < 0 or index < cursor_index or index - cursor_index > self.index_stride:
+            cursor_index, cursor_tick = INDEX_ENTRY.unpack_from(
+                self.map, self.index_offset + (index // self.index_stride) * INDEX_ENTRY.size)[::-1]
+        offset = self.records_offset + (cursor_index + 1) * RECORD.size
+        for i in range(cursor_index + 1, index + 1):
+            cursor_tick += RECORD.unpack_from(self.map, offset)[0]
+            offset += RECORD.size
+        self.cursor = (index, cursor_tick)
+        return cursor_tick
+
+    def time_at(self, index):
+        """
+        :param index: cue number
+        :return: time of that cue in seconds
+        """
+        return self.tick_at(index) / float(self.tick_rate)
+
+    def mask_at(self, index):
+        """
+        :param index: cue number
+        :return: state mask of that cue
+        """
+        return RECORD.unpack_from(self.map, self.records_offset + index * RECORD.size)[1]
+
+    def duration(self):
+        """
+        :return: time of the last cue in seconds
+        """
+        return self.time_at(self.count - 1) if self.count else 0.0
+
+    def _ticks(self, time):
+        """
+        Converts seconds to ticks, ignoring float error far below one tick so a cue time maps to its own tick
+        """
+        return round(time * self.tick_rate, 6)
+
+    def _first_after(self, tick, inclusive):
+        """
+        Finds the first record at (inclusive) or after (not inclusive) tick with a binary search of the index
+        followed by a scan of at most one stride of records
+        :return: record number, self.count if there is none
+        """
+        lo, hi = 0, self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_tick = INDEX_ENTRY.unpack_from(self.map, self.index_offset + mid * INDEX_ENTRY.size)[0]
+            if entry_tick < tick or (not inclusive and entry_tick == tick):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return 0
+        record_tick, first = INDEX_ENTRY.unpack_from(self.map, self.index_offset + (lo - 1) * INDEX_ENTRY.size)
+        offset = self.records_offset + (first + 1) * RECORD.size
+        for index in range(first + 1, min(first + self.index_stride, self.count)):
+            record_tick += RECORD.unpack_from(self.map, offset)[0]
+            if record_tick > tick or (inclusive and record_tick == tick):
+                return index
+            offset += RECORD.size
+        return min(lo * self.index_stride, self.count)
+
+    def index_at(self, time):
+        """
+        :param time: seconds from the start of the show
+        :return: number of the first cue at or after time
+        """
+        return self._first_after(self._ticks(time), True)
+
+    def state_at(self, time):
+        """
+        :param time: seconds from the start of the show
+        :return: the state mask in effect at time
+        """
+        index = self._first_after(self._ticks(time), False)
+        return self.mask_at(index - 1) if index > 0 else 0
@@ -0,0 +1,185 @@
+"""
+Plays a show against a GPIOFireBank from its own thread.
+Cue times are turned into monotonic deadlines. The thread waits on a condition until SPIN seconds before each
+deadline, so start, stop, pause and seek take effect at once, and then spins to hit the edge. Cues are
+applied with GPIOFireBank.set_mask, so the bank's watchdog keeps enforcing max on time during playback.
+"""
+import threading
+from time import monotonic
+
+import RealTime
+from PrecisionTimer import SPIN, spin_until
+
+__author__ = 'Stu D\'Alessandro'
+
+STOPPED = 0
+PLAYING = 1
+PAUSED = 2
+
+
+class ShowPlayer(object):
+    """ Plays one show at a time """
+    def __init__(self, bank, spin=SPIN):
+        """
+        :param bank: the GPIOFireBank to drive
+        :param spin: seconds before each cue at which the thread stops sleeping and spins
+        :return: nil
+        """
+        self.bank = bank
+        self.spin = spin
+        self.show = None
+        self.state = STOPPED
+        self.position = 0.0  # show time in seconds while stopped or paused
+        self.origin = 0.0  # monotonic time of show time zero while playing
+        self.index = 0  # next cue to apply
+        self.resume = False  # apply the state before cue self.index when playback (re)starts
+        self.generation = 0  # bumped by every command so a cue being spun on can be abandoned
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self, show):
+        """
+        Stops any show that is playing and loads a new one
+        :param show: Show, or anything with the same cue methods
+        :return: nil
+        """
+        with self.cond:
+            self._stop()
+            self.show = show
+
+    def start(self, at=None):
+        """
+        Starts playing from the current position, resuming if paused
+        :param at: monotonic time at which the current position should play, None for now. If it has already
+        passed, playback joins the show where it would be by now.
+        :return: False if no show is loaded
+        """
+        with self.cond:
+            if self.show is None:
+                return False
+            if self.state != PLAYING:
+                now = monotonic()
+                if at is None:
+                    at = now
+                elif at < now:
+                    self.position += now - at
+                    at = now
+                self.state = PLAYING
+                self._cue_from(self.position, at)
+            return True
+
+    def pause(self):
+        """
+        Holds the current position and turns every channel off
+        :return: nil
+        """
+        with self.cond:
+            if self.state == PLAYING:
+                self.position = max(0.0, monotonic() - self.origin)
+                self.state = PAUSED
+                self._changed()
+                self.bank.kill()
+
+    def stop(self):
+        """
+        Stops playback, rewinds to the start and turns every channel off
+        :return: nil
+        """
+        with self.cond:
+            self._stop()
+
+    def seek(self, position):
+        """
+        Moves to a show time, jumping straight to the state at that time if playing
+        :param position: seconds from the start of the show
+        :return: nil
+        """
+        with self.cond:
+            self.position = max(0.0, position)
+            if self.state == PLAYING:
+                self._cue_from(self.position, monotonic())
+
+    def current_position(self):
+        """
+        :return: show time in seconds
+        """
+        with self.cond:
+            if self.state == PLAYING:
+                return max(0.0, monotonic() - self.origin)
+            return self.position
+
+    def close(self):
+        """
+        Stops playback and ends the thread
+        :return: nil
+        """
+        with self.cond:
+            self._stop()
+            self.running = False
+        self.thread.join()
+
+    def _stop(self):
+        self.state = STOPPED
+        self.position = 0.0
+        self._changed()
+        self.bank.kill()
+
+    def _changed(self):
+        self.generation += 1
+        self.cond.notify()
+
+    def _cue_from(self, position, when):
+        """
+        Lines up the next cue so that position plays at monotonic time when
+        """
+        self.origin = when - position
+        self.index = self.show.index_at(position)
+        self.resume = self.index > 0 or position > 0
+        self._changed()
+
+    def run(self):
+        """
+        Thread body, applies each cue at its deadline
+        :return: nil
+        """
+        RealTime.enter('player')
+        bank = self.bank
+        while True:
+            with self.cond:
+                while self.running and (self.state != PLAYING or self.show is None):
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+                show = self.show
+                if self.resume:
+                    deadline = self.origin + self.position
+                    mask = show.mask_at(self.index - 1) if self.index > 0 else 0
+                elif self.index < len(show):
+                    deadline = self.origin + show.time_at(self.index)
+                    mask = show.mask_at(self.index)
+                else:
+                    # end of the show, the last cue stays in effect
+                    self.state = STOPPED
+                    self.position = 0.0
+                    continue
+
+                timeout = deadline - monotonic() - self.spin
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+                generation = self.generation
+
+            spin_until(deadline)
+
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                bank.set_mask(mask)
+                if self.resume:
+                    self.resume = False
+                else:
+                    self.index += 1
@@ -0,0 +1,247 @@
+"""
+Static show validation: finds choreography the watchdog would cut off before the show is ever played.
+For every channel the show is broken into on segments (run lengths of the channel's bit across the cues) and
+the validator reports every segment longer than the max on time, channels left on by the last cue, the duty
+cycle and cumulative on time of each channel, and the peak number of channels open at once.
+
+With NumPy installed the analysis is vectorized over all cues and channels at once: the masks are expanded
+into a cue x channel bit matrix whose row to row differences mark every segment start and end. Without it the
+same report is built with one pass over the cues that only looks at the bits that change.
+
+Usage: python ShowValidator.py -t 3 [-c 18] [-d 0.5] [-s 6] show.puff
+"""
+import getopt
+import sys
+
+from ShowFile import ShowFile, RECORD
+
+__author__ = 'Stu D\'Alessandro'
+
+# Install NumPy
+numpy_present = True
+try:
+    import numpy as np
+except ImportError:
+    numpy_present = False
+
+EPSILON = 1e-9  # seconds, so a segment of exactly max on time passes despite float error
+
+
+class ShowReport(object):
+    """ What validate() found """
+    def __init__(self, num_channels, duration):
+        self.num_channels = num_channels
+        self.duration = duration
+        self.long_segments = []  # (channel number, start s, length s) longer than the max on time
+        self.left_on = []  # channel numbers still on after the last cue
+        self.on_times = [0.0] * num_channels  # cumulative seconds on, up to the last cue
+        self.duty_cycles = [0.0] * num_channels  # fraction of the show each channel is on
+        self.peak_open = 0  # most channels open at once
+        self.peak_time = 0.0  # when that first happens
+        self.problems = []  # one line per violation
+
+    def ok(self):
+        return not self.problems
+
+    def summary(self):
+        """
+        :return: multi-line text report
+        """
+        lines = ['{0} channels, {1:.1f} s, peak {2} channels open at {3:.3f} s'.format(
+            self.num_channels, self.duration, self.peak_open, self.peak_time)]
+        for i in range(self.num_channels):
+            if self.on_times[i] > 0:
+                lines.append('  channel {0:>3}: on {1:8.2f} s, duty {2:5.1%}'.format(
+                    i + 1, self.on_times[i], self.duty_cycles[i]))
+        lines.extend(self.problems if self.problems else ['No problems found'])
+        return '\n'.join(lines)
+
+
+def cue_arrays(show):
+    """
+    :param show: Show, ShowFile or anything with the same cue methods
+    :return: (times in seconds, masks) as NumPy arrays, read without copying where the show allows it
+    """
+    if isinstance(show, ShowFile):
+        records = np.frombuffer(show.map, dtype=np.dtype([('delta', '<u4'), ('mask', '<u8')]),
+                                count=show.count, offset=show.records_offset)
+        times = np.cumsum(records['delta'], dtype=np.int64) / float(show.tick_rate)
+        return times, records['mask'].astype(np.uint64)
+    if hasattr(show, 'times') and hasattr(show, 'masks'):
+        return np.frombuffer(show.times, dtype=np.float64), np.frombuffer(show.masks, dtype=np.uint64)
+    count = len(show)
+    return (np.fromiter((show.time_at(i) for i in range(count)), dtype=np.float64, count=count),
+            np.fromiter((show.mask_at(i) for i in range(count)), dtype=np.uint64, count=count))
+
+
+def cues(show):
+    """
+    Every cue of a show in order, decoding show file records sequentially rather than through the index
+    :param show: Show, ShowFile or anything with the same cue methods
+    :return: iterator of (time in seconds, mask)
+    """
+    if isinstance(show, ShowFile):
+        tick = 0
+        tick_rate = float(show.tick_rate)
+        with memoryview(show.map) as view:
+            for delta, mask in RECORD.iter_unpack(view[show.records_offset:show.index_offset]):
+                tick += delta
+                yield tick / tick_rate, mask
+    elif hasattr(show, 'times') and hasattr(show, 'masks'):
+        for cue in zip(show.times, show.masks):
+            yield cue
+    else:
+        for i in range(len(show)):
+            yield show.time_at(i), show.mask_at(i)
+
+
+def validate(show, num_channels, max_on_time, max_duty=None, max_open=None, use_numpy=None):
+    """
+    Checks a whole show against the limits of a bank
+    :param show: Show, ShowFile or anything with the same cue methods
+    :param num_channels: channels in the bank
+    :param max_on_time: longest a channel may stay on, seconds
+    :param max_duty: largest fraction of the show a channel may be on, None for no limit
+    :param max_open: most channels that may be open at once, None for no limit
+    :param use_numpy: force the NumPy (True) or pure Python (False) analysis, None to use NumPy if installed
+    :return: ShowReport
+    """
+    if use_numpy is None:
+        use_numpy = numpy_present
+    duration = show.duration() if len(show) else 0.0
+    report = ShowReport(num_channels, duration)
+    if len(show):
+        if use_numpy:
+            _segments_numpy(show, num_channels, max_on_time + EPSILON, report)
+        else:
+            _segments_python(show, num_channels, max_on_time + EPSILON, report)
+    if duration > 0:
+        report.duty_cycles = [on_time / duration for on_time in report.on_times]
+
+    for channel, start, length in report.long_segments:
+        report.problems.append('Channel {0} is on for {1:.3f} s from {2:.3f} s, longer than {3:.3f} s'.format(
+            channel, length, start, max_on_time))
+    for channel in report.left_on:
+        report.problems.append('Channel {0} is still on after the last cue'.format(channel))
+    if max_duty is not None:
+        for i, duty in enumerate(report.duty_cycles):
+            if duty > max_duty:
+                report.problems.append('Channel {0} is on {1:.1%} of the show, more than {2:.1%}'.format(
+                    i + 1, duty, max_duty))
+    if max_open is not None and report.peak_open > max_open:
+        report.problems.append('{0} channels are open at once at {1:.3f} s, more than {2}'.format(
+            report.peak_open, report.peak_time, max_open))
+    return report
+
+
+def _segments_numpy(show, num_channels, limit, report):
+    """
+    Run length analysis of every channel at once. Fills in the report's segments, on times and peak.
+    :param limit: longest allowed segment, seconds
+    """
+    times, masks = cue_arrays(show)
+    count = len(times)
+    shifts = np.arange(num_channels, dtype=np.uint64)
+    bits = ((masks[:, None] >> shifts) & np.uint64(1)).astype(np.int8)  # cue x channel
+
+    open_counts = bits.sum(axis=1)
+    peak = int(open_counts.argmax())
+    report.peak_open = int(open_counts[peak])
+    report.peak_time = float(times[peak])
+
+    # +1 where a segment starts, -1 the cue after it ends; a row of zeros after the last cue closes segments
+    # that are still on, at index count
+    edges = np.diff(bits, axis=0, prepend=np.zeros((1, num_channels), np.int8),
+                    append=np.zeros((1, num_channels), np.int8)).T
+    start_channels, start_cues = np.nonzero(edges == 1)  # channel major, so starts and ends pair up in order
+    end_cues = np.nonzero(edges == -1)[1]
+    end_times = np.append(times, times[-1])
+    starts = times[start_cues]
+    lengths = end_times[end_cues] - starts
+    closed = end_cues < count
+
+    report.on_times = np.bincount(start_channels, weights=lengths, minlength=num_channels).tolist()
+    report.left_on = (start_channels[~closed] + 1).tolist()
+    for i in np.nonzero(closed & (lengths > limit))[0]:
+        report.long_segments.append((int(start_channels[i]) + 1, float(starts[i]), float(lengths[i])))
+
+
+def _segments_python(show, num_channels, limit, report):
+    """
+    The same analysis as _segments_numpy in one pass over the cues
+    :param limit: longest allowed segment, seconds
+    """
+    all_mask = (1 << num_channels) - 1
+    started = [0.0] * num_channels
+    on_times = report.on_times
+    long_segments = report.long_segments
+    state = 0
+    time = 0.0
+    for time, mask in cues(show):
+        mask &= all_mask
+        diff = mask ^ state
+        rising = diff & mask
+        while diff:
+            low = diff & -diff
+            diff ^= low
+            i = low.bit_length() - 1
+            if mask & low:
+                started[i] = time
+            else:
+                length = time - started[i]
+                on_times[i] += length
+                if length > limit:
+                    long_segments.append((i + 1, started[i], length))
+        state = mask
+        if rising:  # only a channel turning on can raise the peak
+            open_count = bin(mask).count('1')
+            if open_count > report.peak_open:
+                report.peak_open = open_count
+                report.peak_time = time
+    while state:
+        low = state & -state
+        state ^= low
+        i = low.bit_length() - 1
+        on_times[i] += time - started[i]
+        report.left_on.append(i + 1)
+
+
+def main(argv):
+    """
+    Validates a show file and prints the report
+    :return: 0 if the show passes, 1 if not
+    """
+    max_on_time = 3.0
+    num_channels = None
+    max_duty = None
+    max_open = None
+    try:
+        opts, args = getopt.getopt(argv, 't:c:d:s:')
+    except getopt.GetoptError:
+        args = []
+    if len(args) != 1:
+        print('Usage ShowValidator -t 3 [-c 18] [-d 0.5] [-s 6] show.puff')
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-t':
+            max_on_time = float(arg)
+        elif opt == '-c':
+            num_channels = int(arg)
+        elif opt == '-d':
+            max_duty = float(arg)
+        elif opt == '-s':
+            max_open = int(arg)
+
+    try:
+        show = ShowFile(args[0])
+    except (IOError, ValueError) as e:
+        print('Unable to load show: {0}'.format(e))
+        sys.exit(2)
+    report = validate(show, num_channels or show.num_channels, max_on_time, max_duty, max_open)
+    print(report.summary())
+    show.close()
+    return 0 if report.ok() else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))